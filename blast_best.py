@@ -9,9 +9,481 @@
 # Jennifer Meneghin                                                              ###
 # Original Perl version: 08/14/2007                                              ###
 # Python version: 01/20/2020                                                     ###
+#                                                                                ###
+# Update:                                                                        ###
+# The input is no longer read into memory. Only the e-value, percent identity    ###
+# and file offset of each query's best hit are kept, and the best lines are      ###
+# read back from the input when the output is written.                           ###
+# With -s the input must already be grouped by query (as BLAST -outfmt 6 and     ###
+# DIAMOND write it). Each query's best hit is written as soon as the next query  ###
+# starts, in input order, so memory use does not depend on the file size.        ###
+#                                                                                ###
+# Update:                                                                        ###
+# -n N keeps the N best hits per query instead of one (best first).              ###
+# -k sets the ranking columns, in order (default evalue,pident). Columns are     ###
+# evalue (smaller is better), bitscore, pident and length (bigger is better).    ###
+# All columns are compared as numbers, so 100.0 now beats 9.5.                   ###
+# Hits that fail --max-evalue, --min-bitscore, --min-pident or --min-length are  ###
+# dropped while the file is read. Equal hits keep the one found first.           ###
+#                                                                                ###
+# Update:                                                                        ###
+# -m MB caps the memory used for input that is not grouped by query. Best hits   ###
+# are kept with their lines until the budget is used up, then written to a      ###
+# temporary file sorted by query id (a "run"), and the runs are merged at the    ###
+# end, keeping the best hits again where a query is in more than one run.        ###
+# -T sets the directory for the temporary files.                                 ###
+#                                                                                ###
+# Update:                                                                        ###
+# -p N parses input that is not grouped by query with N processes. The file is   ###
+# split into line aligned byte ranges, each range is reduced to its best hits,   ###
+# which are sharded by a CRC of the query id and written to temporary files      ###
+# (in the -T directory). Each shard's files are then merged by a worker, and     ###
+# the shards are merged into the output by query id. Ties are broken by file    ###
+# offset, as in one process.                                                     ###
+#                                                                                ###
+# Update:                                                                        ###
+# -c keeps a columnar cache of the parsed table in <input file>.bbcache/: NumPy  ###
+# arrays of the line offsets, query ids (as numbers into a sorted table of the   ###
+# ids), e-values, bitscores, percent identities and lengths. When the input's    ###
+# size, mtime and sampled hash still match, the arrays are memory-mapped instead ###
+# of parsing the text again, and the filters and top N are done with a sort.     ###
+#                                                                                ###
+# Update:                                                                        ###
+# -f <fasta file> writes the sequences of the best hits' queries (or subjects    ###
+# with --subject) to the -q file, in output order. The fasta file is read by     ###
+# random access through a samtools style .fai index, which is built next to the  ###
+# fasta file the first time and reused after that.                               ###
 ####################################################################################
 
-import re, sys, getopt
+import hashlib, heapq, json, os, sys, getopt, tempfile, zlib
+from itertools import groupby
+from multiprocessing import Pool
+from seq_reader import fasta_index, fetch_sequence
+
+#Short format BLAST columns that can be used to rank or filter hits,
+#with their column number and +1 if smaller is better, -1 if bigger is better
+COLUMNS = {"evalue": (10, 1), "bitscore": (11, -1), "pident": (2, -1), "length": (3, -1)}
+
+#Rough bytes of memory used to keep one hit, on top of its line
+HIT_OVERHEAD = 250
+#Most runs merged at once; more runs than this are merged in rounds
+MERGE_WIDTH = 128
+#Bytes of input parsed by one worker task (-p)
+CHUNK_SIZE = 64 << 20
+#Cache format version, and bytes read from the start, middle and end
+#of the input for the cache's file hash
+CACHE_VERSION = 1
+HASH_SAMPLE = 1 << 20
+#Columns kept in the cache
+CACHE_COLUMNS = ("evalue", "bitscore", "pident", "length")
+
+#Ranking values of a hit (smaller is better)
+def hit_rank(fields, ranking):
+    return tuple([sign * float(fields[column]) for column, sign in ranking])
+
+#----------------------------------------------------------------------
+#Read a short format BLAST file (opened in binary mode), skipping
+#comment lines and hits that fail a filter. filters is a list of
+#(column number, minimum, maximum). Yields (offset, line, query id,
+#rank) for each hit, where offset is where the line starts and rank
+#is the tuple of ranking values (smaller is better). counts["total"]
+#and counts["filtered"] are updated as the file is read. IN must be
+#positioned at offset; reading stops at end (or the end of the file).
+#----------------------------------------------------------------------
+def read_hits(IN, ranking, filters, counts, offset=0, end=None):
+    for line in IN:
+        if end is not None and offset >= end:
+            break
+        start = offset
+        offset += len(line)
+        if line[:1] == b"#":
+            continue
+        counts["total"]+=1
+        fields = line.split(b"\t", 12)
+        if len(fields) < 12:
+            raise ValueError("Got a bad line:"+line.decode(errors="replace"))
+        keep = True
+        for column, minimum, maximum in filters:
+            value = float(fields[column])
+            if value < minimum or value > maximum:
+                keep = False
+                break
+        if not keep:
+            counts["filtered"]+=1
+            continue
+        yield start, line, fields[0], hit_rank(fields, ranking)
+
+#----------------------------------------------------------------------
+#Keep the n best hits of one query in a heap. The heap holds the
+#negated (rank, offset), so heap[0] is the worst hit kept, and a new
+#hit only gets in if it ranks strictly better (a tie keeps the hit
+#found first, because its offset is smaller). line can be None when
+#the line is read back later by offset. Returns the item that was
+#dropped (the new one, or the one it replaced), or None.
+#----------------------------------------------------------------------
+def keep_hit(heap, n, rank, offset, line=None):
+    item = (tuple([-i for i in rank]), -offset, line)
+    if len(heap) < n:
+        heapq.heappush(heap, item)
+        return None
+    if item > heap[0]:
+        return heapq.heapreplace(heap, item)
+    return item
+
+#(offset, line) of the kept hits, best first
+def ranked(heap):
+    return [(-offset, line) for rank, offset, line in sorted(heap, reverse=True)]
+
+#------------------------------------------------------------------------
+#Streaming mode for input grouped by query: keep only the current
+#query's best hits, and write them when the query id changes.
+#Returns the number of hits written.
+#------------------------------------------------------------------------
+def best_grouped(IN, OUT, n, ranking, filters, counts):
+    counter = 0
+    this_id = None
+    heap = []
+    for offset, line, query_id, rank in read_hits(IN, ranking, filters, counts):
+        if query_id != this_id:
+            for offset_kept, line_kept in ranked(heap):
+                OUT.write(line_kept)
+                counter+=1
+            this_id = query_id
+            heap = []
+        keep_hit(heap, n, rank, offset, line)
+    for offset_kept, line_kept in ranked(heap):
+        OUT.write(line_kept)
+        counter+=1
+    return counter
+
+#------------------------------------------------------------------------
+#Any order: keep (rank, offset) of the best hits for each query.
+#Returns the best hits by query id.
+#------------------------------------------------------------------------
+def find_best(IN, n, ranking, filters, counts):
+    dedupe = {}
+    for offset, line, query_id, rank in read_hits(IN, ranking, filters, counts):
+        heap = dedupe.get(query_id)
+        if heap is None:
+            heap = dedupe[query_id] = []
+        keep_hit(heap, n, rank, offset)
+    return dedupe
+
+#----------------------------------------------------------------
+#Read the best lines back from the input, sorted by query id
+#(and best first within a query)
+#----------------------------------------------------------------
+def write_best(IN, OUT, dedupe):
+    counter = 0
+    for query_id in sorted(dedupe):
+        for offset, line in ranked(dedupe[query_id]):
+            IN.seek(offset)
+            OUT.write(IN.readline())
+            counter+=1
+    return counter
+
+#--------------------------------------------------------------------
+#Write the kept hits to a temporary file (RUN) sorted by query id,
+#one "offset<tab>line" per hit, best first within a query
+#--------------------------------------------------------------------
+def write_run(dedupe, RUN):
+    for query_id in sorted(dedupe):
+        for offset, line in ranked(dedupe[query_id]):
+            if line[-1:] != b"\n":
+                line += b"\n"
+            RUN.write(b"%d\t%s" % (offset, line))
+    RUN.seek(0)
+    return RUN
+
+#(query id, offset, line) for each hit in a run
+def read_run(RUN):
+    for entry in RUN:
+        offset, line = entry.split(b"\t", 1)
+        yield line[:line.find(b"\t")], int(offset), line
+
+#-----------------------------------------------------------------
+#Merge sorted runs, keeping the n best hits of each query. Yields
+#(offset, line) of the hits kept, by query id and best first.
+#-----------------------------------------------------------------
+def merge_runs(runs, n, ranking):
+    hits = heapq.merge(*[read_run(RUN) for RUN in runs], key=lambda hit: hit[0])
+    for query_id, group in groupby(hits, key=lambda hit: hit[0]):
+        heap = []
+        for query_id, offset, line in group:
+            keep_hit(heap, n, hit_rank(line.split(b"\t", 12), ranking), offset, line)
+        yield from ranked(heap)
+
+#-------------------------------------------------------------
+#Merge runs in rounds of MERGE_WIDTH until no more than that
+#are left. Returns the remaining runs.
+#-------------------------------------------------------------
+def merge_rounds(runs, n, ranking, temp_dir):
+    while len(runs) > MERGE_WIDTH:
+        merged = []
+        for i in range(0, len(runs), MERGE_WIDTH):
+            RUN = tempfile.TemporaryFile(dir=temp_dir)
+            for offset, line in merge_runs(runs[i:i+MERGE_WIDTH], n, ranking):
+                RUN.write(b"%d\t%s" % (offset, line))
+            RUN.seek(0)
+            merged.append(RUN)
+            for OLD in runs[i:i+MERGE_WIDTH]:
+                OLD.close()
+        runs = merged
+    return runs
+
+#------------------------------------------------------------------------
+#Any order, bounded memory: keep the best hits with their lines until
+#about "budget" bytes are used, then spill them to a sorted run. The
+#runs are merged (in rounds of MERGE_WIDTH) into the output.
+#Returns the number of hits written.
+#------------------------------------------------------------------------
+def best_external(IN, OUT, n, ranking, filters, counts, budget, temp_dir):
+    runs = []
+    dedupe = {}
+    used = 0
+    for offset, line, query_id, rank in read_hits(IN, ranking, filters, counts):
+        heap = dedupe.get(query_id)
+        if heap is None:
+            heap = dedupe[query_id] = []
+        dropped = keep_hit(heap, n, rank, offset, line)
+        used += len(line) + HIT_OVERHEAD
+        if dropped is not None:
+            used -= len(dropped[2]) + HIT_OVERHEAD
+        if used >= budget:
+            runs.append(write_run(dedupe, tempfile.TemporaryFile(dir=temp_dir)))
+            dedupe = {}
+            used = 0
+    if dedupe or not runs:
+        runs.append(write_run(dedupe, tempfile.TemporaryFile(dir=temp_dir)))
+    del dedupe
+    runs = merge_rounds(runs, n, ranking, temp_dir)
+    counter = 0
+    for offset, line in merge_runs(runs, n, ranking):
+        OUT.write(line)
+        counter+=1
+    for RUN in runs:
+        RUN.close()
+    return counter
+
+#-----------------------------------------------------------------
+#Split a file into about "count" byte ranges that each start at
+#the beginning of a line. Returns a list of (start, end) offsets.
+#-----------------------------------------------------------------
+def line_ranges(in_file, count):
+    IN = open(in_file, "rb")
+    size = IN.seek(0, 2)
+    offsets = [0]
+    for i in range(1, count):
+        position = max(size * i // count, offsets[-1])
+        if position >= size:
+            break
+        IN.seek(position)
+        IN.readline()
+        position = IN.tell()
+        if position >= size:
+            break
+        if position > offsets[-1]:
+            offsets.append(position)
+    IN.close()
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+#Settings for the worker processes (set by init_workers)
+SETTINGS = {}
+
+def init_workers(in_file, n, ranking, filters, shards, temp_dir):
+    SETTINGS["in_file"] = in_file
+    SETTINGS["n"] = n
+    SETTINGS["ranking"] = ranking
+    SETTINGS["filters"] = filters
+    SETTINGS["shards"] = shards
+    SETTINGS["temp_dir"] = temp_dir
+
+#-------------------------------------------------------------------
+#Worker: reduce one byte range to the best hits of each query, split
+#into shards by a CRC of the query id (hash() differs between
+#processes), and write each shard to a run in temp_dir. Returns
+#(counts, list of run file names, None for an empty shard).
+#-------------------------------------------------------------------
+def reduce_range(span):
+    start, end = span
+    counts = {"total": 0, "filtered": 0}
+    shards = [{} for i in range(SETTINGS["shards"])]
+    n = SETTINGS["n"]
+    IN = open(SETTINGS["in_file"], "rb")
+    IN.seek(start)
+    for offset, line, query_id, rank in read_hits(IN, SETTINGS["ranking"], SETTINGS["filters"], counts, start, end):
+        dedupe = shards[zlib.crc32(query_id) % len(shards)]
+        heap = dedupe.get(query_id)
+        if heap is None:
+            heap = dedupe[query_id] = []
+        keep_hit(heap, n, rank, offset, line)
+    IN.close()
+    runs = []
+    for dedupe in shards:
+        if not dedupe:
+            runs.append(None)
+            continue
+        RUN = write_run(dedupe, tempfile.NamedTemporaryFile(dir=SETTINGS["temp_dir"], delete=False))
+        RUN.close()
+        runs.append(RUN.name)
+    return counts, runs
+
+#--------------------------------------------------------------------
+#Worker: merge one shard's runs from every range into a single run,
+#keeping the n best hits of each query. Returns the run's file name.
+#--------------------------------------------------------------------
+def reduce_shard(names):
+    n = SETTINGS["n"]
+    ranking = SETTINGS["ranking"]
+    runs = merge_rounds([open(name, "rb") for name in names], n, ranking, SETTINGS["temp_dir"])
+    with tempfile.NamedTemporaryFile(dir=SETTINGS["temp_dir"], delete=False) as RUN:
+        for offset, line in merge_runs(runs, n, ranking):
+            RUN.write(b"%d\t%s" % (offset, line))
+    for OLD in runs:
+        OLD.close()
+    for name in names:
+        os.remove(name)
+    return RUN.name
+
+#--------------------------------------------------------------------
+#Any order, with "processes" worker processes. The ranges are reduced
+#and written to per-shard runs, then each shard's runs are merged by
+#a worker, and the shards (which hold different queries) are merged
+#into the output by query id. Returns the number of hits written.
+#--------------------------------------------------------------------
+def best_parallel(in_file, OUT, n, ranking, filters, counts, processes, temp_dir):
+    spans = line_ranges(in_file, max(processes * 4, os.path.getsize(in_file) // CHUNK_SIZE))
+    shards = [[] for i in range(processes)]
+    with tempfile.TemporaryDirectory(dir=temp_dir) as run_dir:
+        with Pool(processes, init_workers, (in_file, n, ranking, filters, processes, run_dir)) as pool:
+            for range_counts, runs in pool.imap(reduce_range, spans):
+                counts["total"] += range_counts["total"]
+                counts["filtered"] += range_counts["filtered"]
+                for names, name in zip(shards, runs):
+                    if name is not None:
+                        names.append(name)
+            merged = [open(name, "rb") for name in pool.map(reduce_shard, [names for names in shards if names])]
+        counter = 0
+        for query_id, offset, line in heapq.merge(*[read_run(RUN) for RUN in merged], key=lambda hit: hit[0]):
+            OUT.write(line)
+            counter+=1
+        for RUN in merged:
+            RUN.close()
+    return counter
+
+#------------------------------------------------------------------
+#Identify a version of the input file: its size, mtime and a hash
+#of HASH_SAMPLE bytes from the start, middle and end
+#------------------------------------------------------------------
+def file_signature(in_file):
+    stat = os.stat(in_file)
+    digest = hashlib.blake2b(str(stat.st_size).encode())
+    with open(in_file, "rb") as IN:
+        for position in (0, stat.st_size // 2, stat.st_size - HASH_SAMPLE):
+            IN.seek(max(position, 0))
+            digest.update(IN.read(HASH_SAMPLE))
+    return {"version": CACHE_VERSION, "size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+#-----------------------------------------------------------------------
+#Parse the input into the columns of the cache and save them as .npy
+#files in cache_dir. Query ids are numbered in sorted order, so sorting
+#by number sorts by id. The signature is written last, so a cache that
+#was only partly written is never used.
+#-----------------------------------------------------------------------
+def build_cache(IN, cache_dir, signature):
+    import numpy as np
+    from array import array
+    offsets = array("q")
+    queries = array("q")
+    values = dict([(name, array("d")) for name in CACHE_COLUMNS])
+    ids = {}
+    counts = {"total": 0, "filtered": 0}
+    for offset, line, query_id, rank in read_hits(IN, [COLUMNS[name] for name in CACHE_COLUMNS], (), counts):
+        offsets.append(offset)
+        number = ids.get(query_id)
+        if number is None:
+            number = ids[query_id] = len(ids)
+        queries.append(number)
+        for name, value in zip(CACHE_COLUMNS, rank):
+            values[name].append(value * COLUMNS[name][1])
+    names = sorted(ids)
+    order = np.empty(len(names), dtype=np.int64)
+    order[[ids[name] for name in names]] = np.arange(len(names), dtype=np.int64)
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(os.path.join(cache_dir, "signature.json")):
+        os.remove(os.path.join(cache_dir, "signature.json"))
+    np.save(os.path.join(cache_dir, "offset.npy"), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(cache_dir, "query.npy"), order[np.frombuffer(queries, dtype=np.int64)].astype(np.int32 if len(names) < 2**31 else np.int64))
+    for name in CACHE_COLUMNS:
+        np.save(os.path.join(cache_dir, name+".npy"), np.frombuffer(values[name], dtype=np.float64))
+    id_ends = np.cumsum([len(name) for name in names], dtype=np.int64)
+    np.save(os.path.join(cache_dir, "id_ends.npy"), id_ends)
+    np.save(os.path.join(cache_dir, "ids.npy"), np.frombuffer(b"".join(names), dtype=np.uint8))
+    with open(os.path.join(cache_dir, "signature.json"), "w") as SIGNATURE:
+        json.dump(signature, SIGNATURE)
+
+#-----------------------------------------------------------------------
+#Memory-map the cache columns. Returns a dict of arrays, or None when
+#there is no cache or it was made from a different version of the input.
+#-----------------------------------------------------------------------
+def load_cache(cache_dir, signature):
+    import numpy as np
+    try:
+        with open(os.path.join(cache_dir, "signature.json")) as SIGNATURE:
+            if json.load(SIGNATURE) != signature:
+                return None
+        return dict([(name, np.load(os.path.join(cache_dir, name+".npy"), mmap_mode="r")) for name in ("offset", "query", "id_ends", "ids") + CACHE_COLUMNS])
+    except (OSError, ValueError):
+        return None
+
+#-------------------------------------------------------------------------
+#Best hits from the cache columns: filter, sort by query, rank and offset,
+#and keep the first n of each query. Returns (offsets of the best hits
+#by query id and best first, number filtered out).
+#-------------------------------------------------------------------------
+def best_cached(cache, n, ranking, filters):
+    import numpy as np
+    names = dict([(column, name) for name, (column, sign) in COLUMNS.items()])
+    keep = np.ones(len(cache["offset"]), dtype=bool)
+    for column, minimum, maximum in filters:
+        values = cache[names[column]]
+        keep &= (values >= minimum) & (values <= maximum)
+    rows = np.flatnonzero(keep)
+    query = np.asarray(cache["query"])[rows]
+    offset = np.asarray(cache["offset"])[rows]
+    keys = [offset] + [sign * np.asarray(cache[names[column]])[rows] for column, sign in reversed(ranking)] + [query]
+    order = np.lexsort(keys)
+    query = query[order]
+    first = np.flatnonzero(np.r_[True, query[1:] != query[:-1]])
+    position = np.arange(len(query)) - np.repeat(first, np.diff(np.r_[first, len(query)]))
+    return offset[order][position < n], len(keep) - len(rows)
+
+#-----------------------------------------------------------------------
+#Write the sequence of each query (column 0) or subject (column 1) in
+#the best hits file to a fasta file, once each and in order, fetched
+#from an indexed fasta file. Returns (sequences written, ids not found).
+#-----------------------------------------------------------------------
+def write_sequences(best_file, fasta_file, seq_file, column):
+    index = fasta_index(fasta_file)
+    written = set()
+    missing = set()
+    with open(best_file, "rb") as BEST, open(fasta_file, "rb") as FASTA, open(seq_file, "wb") as SEQ:
+        for line in BEST:
+            name = line.split(b"\t", 2)[column].decode()
+            if name in written or name in missing:
+                continue
+            entry = index.get(name)
+            if entry is None:
+                missing.add(name)
+                continue
+            written.add(name)
+            seq = fetch_sequence(FASTA, entry)
+            width = entry[2] or len(seq) or 1
+            SEQ.write(b">" + name.encode() + b"\n")
+            for start in range(0, len(seq), width):
+                SEQ.write(seq[start:start+width] + b"\n")
+    return len(written), len(missing)
 
 ###############
 #The Main Event
@@ -23,70 +495,156 @@ def main(argv):
     #---------------------------
     in_file = ""
     out_file = "best.blast"
+    grouped = False
+    top = 1
+    rank_by = "evalue,pident"
+    limits = {}
+    memory = None
+    temp_dir = None
+    processes = 1
+    cache = False
+    fasta_file = None
+    seq_file = None
+    seq_column = 0
     try:
-        opts, args = getopt.getopt(argv,"hi:o:",["ifile=","ofile="])
+        opts, args = getopt.getopt(argv,"hi:o:sn:k:m:T:p:t:cf:q:",["ifile=","ofile=","sorted","top=","rank=","max-evalue=","min-bitscore=","min-pident=","min-length=","memory=","tmpdir=","processes=","threads=","cache","fasta=","seqfile=","subject"])
     except getopt.GetoptError:
         print("\nNot a valid argument or value")
-        print("blast_best.py -i <BLAST input file> -o <BLAST output file>\n")
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
         sys.exit(2)        
     for opt, arg in opts:
         if opt == "-h":
-            print("\nblast_best.py -i <BLAST input file> -o <BLAST output file>\n")
+            print("\nblast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
             sys.exit()
         elif opt in ("-i", "--ifile"):
             in_file = arg
         elif opt in ("-o", "--ofile"):
             out_file = arg
+        elif opt in ("-s", "--sorted"):
+            grouped = True
+        elif opt in ("-n", "--top"):
+            top = arg
+        elif opt in ("-k", "--rank"):
+            rank_by = arg
+        elif opt in ("--max-evalue", "--min-bitscore", "--min-pident", "--min-length"):
+            limits[opt[2:]] = arg
+        elif opt in ("-m", "--memory"):
+            memory = arg
+        elif opt in ("-T", "--tmpdir"):
+            temp_dir = arg
+        elif opt in ("-p", "--processes", "-t", "--threads"):
+            processes = arg
+        elif opt in ("-c", "--cache"):
+            cache = True
+        elif opt in ("-f", "--fasta"):
+            fasta_file = arg
+        elif opt in ("-q", "--seqfile"):
+            seq_file = arg
+        elif opt == "--subject":
+            seq_column = 1
+
+    #----------------------------------------
+    #Check the ranking columns and thresholds
+    #----------------------------------------
+    try:
+        top = int(top)
+        processes = int(processes)
+        if memory is not None:
+            memory = float(memory)
+        filters = []
+        for name, value in limits.items():
+            column = COLUMNS[name[4:]][0]
+            if name.startswith("max"):
+                filters.append((column, float("-inf"), float(value)))
+            else:
+                filters.append((column, float(value), float("inf")))
+        ranking = [COLUMNS[name] for name in rank_by.split(",")]
+    except (KeyError, ValueError):
+        print("\nNot a valid value: -n, -m, -p and the thresholds must be numbers, and -k a comma separated list of "+",".join(COLUMNS))
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
+        sys.exit(2)
+    if top < 1 or processes < 1 or (memory is not None and memory <= 0):
+        print("\nNot a valid value: -n, -m and -p must be more than 0")
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
+        sys.exit(2)
+
+    if memory is not None and processes > 1:
+        print("\n-m and -p can't be used together")
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
+        sys.exit(2)
+
+    if fasta_file is not None and seq_file is None:
+        seq_file = out_file + ".fasta"
+    if fasta_file is not None and not os.path.exists(fasta_file):
+        print("\nFasta File could not be found")
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
+        sys.exit(2)
 
     #----------------------------------
     #Open Files for reading and writing
     #----------------------------------
     try:
-        IN = open(in_file,"r")
+        IN = open(in_file,"rb")
     except FileNotFoundError:
         print("\nBLAST Input File could not be found")
-        print("blast_best.py -i <BLAST input file> -o <BLAST output file>\n")
+        print("blast_best.py -i <BLAST input file> -o <BLAST output file> [-s (input is grouped by query)] [-n <hits per query>] [-k <ranking columns>] [--max-evalue=X] [--min-bitscore=X] [--min-pident=X] [--min-length=X] [-m <memory MB>] [-T <temp directory>] [-p <number of processes>] [-c (use a cache)] [-f <fasta file> -q <sequence output file> [--subject]]\n")
         sys.exit(2)
-    OUT = open(out_file,"w")
+    OUT = open(out_file,"wb")
 
     
     #Everything looks good. Print the parameters we've found.
-    print("\nParameters:\ninput file = "+in_file+"\noutput file = "+out_file+"\n")
+    print("\nParameters:\ninput file = "+in_file+"\noutput file = "+out_file+"\nhits per query = "+str(top)+"\nranked by = "+rank_by)
+    for name, value in limits.items():
+        print(name+" = "+value)
+    if memory is not None and not grouped:
+        print("memory = "+str(memory)+" MB")
+    if processes > 1 and not grouped and not cache:
+        print("processes = "+str(processes))
+    if cache:
+        print("cache = "+in_file+".bbcache")
+    if fasta_file is not None:
+        print("fasta file = "+fasta_file+"\nsequence output file = "+seq_file+"\nsequences of = "+("subjects" if seq_column else "queries"))
+    print("")
     
     #--------------------------------------
     #Read and Process Short Form BLAST File
     #--------------------------------------
-    counter = 0
-    total_counter = 0
-    lines = IN.readlines()
-    dedupe = {}
-    for line in lines:
-        if not re.search("^#",line):
-            total_counter+=1
-            fields = re.split("\t",line)
-            if len(fields) >= 12:
-                this_id = fields[0]
-                percent_identity = fields[2]
-                evalue = fields[10]
-            else:
-                print("Got a bad line:"+str(line))
-                sys.exit(2)               
-            if this_id in dedupe:
-                oldvalue = re.split("\t",dedupe[this_id])
-                list_percent_identity = oldvalue[2]
-                list_evalue = oldvalue[10]
-                if float(evalue) < float(list_evalue):
-                    dedupe[this_id] = line
-                elif float(evalue) == float(list_evalue):
-                    if percent_identity > list_percent_identity:
-                        dedupe[this_id] = line
+    counts = {"total": 0, "filtered": 0}
+    try:
+        if cache:
+            cache_dir = in_file+".bbcache"
+            signature = file_signature(in_file)
+            columns = load_cache(cache_dir, signature)
+            if columns is None:
+                print("Building cache...")
+                build_cache(IN, cache_dir, signature)
+                columns = load_cache(cache_dir, signature)
             else:
-              dedupe[this_id] = line
-              counter+=1
-    print("Total # records = "+str(total_counter)+"\nBest only # records = "+str(counter))
-    print("Writing to output file...")
-    for key,value in sorted(dedupe.items()):
-        OUT.write(str(value))
+                print("Using cache...")
+            offsets, counts["filtered"] = best_cached(columns, top, ranking, filters)
+            counts["total"] = len(columns["offset"])
+            counter = len(offsets)
+            for offset in offsets.tolist():
+                IN.seek(offset)
+                OUT.write(IN.readline())
+        elif grouped:
+            counter = best_grouped(IN, OUT, top, ranking, filters, counts)
+        elif memory is not None:
+            counter = best_external(IN, OUT, top, ranking, filters, counts, int(memory * 1048576), temp_dir)
+        elif processes > 1:
+            counter = best_parallel(in_file, OUT, top, ranking, filters, counts, processes, temp_dir)
+        else:
+            dedupe = find_best(IN, top, ranking, filters, counts)
+            counter = sum(len(heap) for heap in dedupe.values())
+    except ValueError as error:
+        print(str(error))
+        sys.exit(2)
+    print("Total # records = "+str(counts["total"])+"\nBest only # records = "+str(counter))
+    if filters:
+        print("Filtered out # records = "+str(counts["filtered"]))
+    if not grouped and not cache and memory is None and processes == 1:
+        print("Writing to output file...")
+        write_best(IN, OUT, dedupe)
 
     #-----------
     #Close Files
@@ -94,6 +652,19 @@ def main(argv):
     IN.close()
     OUT.close()
 
+    #----------------------------------------
+    #Pull the best hits' sequences from fasta
+    #----------------------------------------
+    if fasta_file is not None:
+        print("Writing sequences...")
+        try:
+            found, missing = write_sequences(out_file, fasta_file, seq_file, seq_column)
+        except ValueError as error:
+            print(str(error))
+            sys.exit(2)
+        print("Sequences written = "+str(found))
+        if missing:
+            print("Not found in fasta file = "+str(missing))
+
 if __name__ == "__main__":
     main(sys.argv[1:])
-
@@ -0,0 +1,89 @@
+#####################################################################################
+### Composition                                                                   ###
+### Single pass nucleotide composition counting shared by the GC content scripts. ###
+###                                                                               ###
+### count_composition(seq) returns a dictionary with the count of every letter    ###
+### (upper and lower case are counted together) plus:                             ###
+### "Total"     = total count of letters                                          ###
+### "Ambiguous" = total count of IUPAC ambiguity codes other than N               ###
+###               (R, Y, S, W, K, M, B, D, H, V)                                  ###
+###                                                                               ###
+### The sequence is viewed as an array of bytes and counted with one bincount,    ###
+### in blocks of BLOCK_SIZE so the temporary arrays stay small on whole           ###
+### chromosomes.                                                                  ###
+#####################################################################################
+
+import numpy as np
+
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+AMBIGUOUS = "RYSWKMBDHV"
+BLOCK_SIZE = 1 << 22
+
+#---------------------------------------------------
+#Count every byte value (0-255) found in the sequence
+#---------------------------------------------------
+def byte_counts(seq):
+    if isinstance(seq, str):
+        seq = seq.encode("ascii", "replace")
+    codes = np.frombuffer(seq, dtype=np.uint8)
+    if len(codes) <= BLOCK_SIZE:
+        return np.bincount(codes, minlength=256)
+    counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, len(codes), BLOCK_SIZE):
+        counts += np.bincount(codes[start:start+BLOCK_SIZE], minlength=256)
+    return counts
+
+#----------------------------------------
+#Count letters, ignoring upper/lower case
+#----------------------------------------
+def count_composition(seq):
+    counts = byte_counts(seq)
+    letters = counts[ord("A"):ord("Z")+1] + counts[ord("a"):ord("z")+1]
+    letters = letters.tolist()
+    composition = dict(zip(LETTERS, letters))
+    composition["Total"] = sum(letters)
+    composition["Ambiguous"] = sum([composition[i] for i in AMBIGUOUS])
+    return composition
+
+#----------------------------------------------------------------
+#Sliding windows of GC content and GC skew for one sequence.
+#Yields (starts, ends, gc percents, gc skews) as NumPy arrays, one
+#block at a time. Every window is read off cumulative G, C and
+#letter counts, so each block costs O(block length) no matter how
+#big the window is. The last window is cut short at the end of
+#the sequence when the windows don't fit exactly.
+#----------------------------------------------------------------
+def gc_windows(seq, window, step):
+    if isinstance(seq, str):
+        seq = seq.encode("ascii", "replace")
+    codes = np.frombuffer(seq, dtype=np.uint8)
+    length = len(codes)
+    if length == 0:
+        return
+    starts = np.arange(0, max(length - window, 0) + 1, step, dtype=np.int64)
+    ends = np.minimum(starts + window, length)
+    if ends[-1] < length and starts[-1] + step < length:
+        starts = np.append(starts, starts[-1] + step)
+        ends = np.append(ends, length)
+    per_block = max(1, (BLOCK_SIZE - window) // step)
+    for first in range(0, len(starts), per_block):
+        block_starts = starts[first:first+per_block]
+        block_ends = ends[first:first+per_block]
+        offset = block_starts[0]
+        folded = codes[offset:block_ends[-1]] | 0x20
+        g = np.zeros(len(folded) + 1, dtype=np.int64)
+        c = np.zeros(len(folded) + 1, dtype=np.int64)
+        letters = np.zeros(len(folded) + 1, dtype=np.int64)
+        np.cumsum(folded == ord("g"), out=g[1:])
+        np.cumsum(folded == ord("c"), out=c[1:])
+        np.cumsum((folded >= ord("a")) & (folded <= ord("z")), out=letters[1:])
+        left = block_starts - offset
+        right = block_ends - offset
+        gcount = g[right] - g[left]
+        ccount = c[right] - c[left]
+        total = letters[right] - letters[left]
+        gccount = gcount + ccount
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gccontent = np.where(total > 0, (100 * gccount) / total, 0.0)
+            skew = np.where(gccount > 0, (gcount - ccount) / gccount, 0.0)
+        yield block_starts, block_ends, gccontent, skew
@@ -10,30 +10,78 @@
 ### column 5 = total count of Cs (or cs)                                          ###
 ### column 6 = total count of As (or as)                                          ###
 ### column 7 = total count of Ts (or ts)                                          ###
+### column 8 = total count of Ns (or ns)                                          ###
+### column 9 = total count of other IUPAC ambiguity codes (R,Y,S,W,K,M,B,D,H,V)   ###
+###                                                                               ###
+### With -w <window size> (and optionally -s <step size>, default = window size)  ###
+### it instead writes a BED style table with one row per window:                 ###
+### column 1 = ID (header up to the first space)                                  ###
+### column 2 = window start (0 based)                                             ###
+### column 3 = window end (not included)                                          ###
+### column 4 = %gc content for the window                                         ###
+### column 5 = gc skew for the window, (G-C)/(G+C)                                ###
+###                                                                               ###
+### With -p <number of processes> (or -t) the whole record table is computed in  ###
+### parallel over byte ranges of the input and written in the same order as a    ###
+### single process run. The window table is always computed in one process.      ###
 ###                                                                               ###
 ### Jennifer Meneghin                                                             ###
 ### 01/20/2020                                                                    ###
 ###                                                                               ###
 #####################################################################################
 
-import re, sys, getopt
+import os, sys, getopt
+from multiprocessing import Pool
+from seq_reader import read_fasta, record_ranges, FileRange
+from composition import count_composition, gc_windows
+
+SHARD_SIZE = 64 << 20
 
 #################
 #Process Sequence
 #################
 def process_seq(seq):
-    seq = seq.upper()
-    acount = len(re.findall("A",seq))
-    ccount = len(re.findall("C",seq))
-    gcount = len(re.findall("G",seq))
-    tcount = len(re.findall("T",seq))
+    composition = count_composition(seq)
+    acount = composition["A"]
+    ccount = composition["C"]
+    gcount = composition["G"]
+    tcount = composition["T"]
     gccount = ccount + gcount
-    totalcount = len(re.findall("[A-Z]",seq))
+    totalcount = composition["Total"]
     if totalcount > 0:
         gccontent = (100 * gccount) / totalcount
     else:
         gccontent = 0
-    return [gccontent, totalcount, gcount, ccount, acount, tcount]
+    return [gccontent, totalcount, gcount, ccount, acount, tcount, composition["N"], composition["Ambiguous"]]
+
+#####################
+#Format One Table Row
+#####################
+def format_row(header, seq):
+    result = process_seq(seq)
+    return header.decode() + "\t" + "%f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\n" % tuple(result)
+
+#######################################################
+#Process One Byte Range of the FASTA file (pool worker)
+#######################################################
+def process_range(job):
+    in_file, start, end = job
+    with FileRange(in_file, start, end) as IN:
+        return "".join(format_row(header, seq) for header, seq in read_fasta(IN))
+
+##########################################
+#Write Sliding Window GC Content and Skew
+##########################################
+def write_windows(IN, OUT, window, step):
+    OUT.write("#ID\tStart\tEnd\t%GC Content\tGC Skew\n")
+    for header, seq in read_fasta(IN):
+        fields = header.decode().split()
+        chrom = fields[0] if fields else ""
+        for starts, ends, gccontent, skew in gc_windows(seq, window, step):
+            rows = []
+            for start, end, gc, gcskew in zip(starts.tolist(), ends.tolist(), gccontent.tolist(), skew.tolist()):
+                rows.append("%s\t%d\t%d\t%f\t%f\n" % (chrom, start, end, gc, gcskew))
+            OUT.write("".join(rows))
 
 ###############
 #The Main Event
@@ -45,29 +93,53 @@ def main(argv):
     #---------------------------
     in_file = ""
     out_file = "gc_out.txt"
+    window = 0
+    step = 0
+    processes = 1
     try:
-        opts, args = getopt.getopt(argv,"hi:o:",["ifile=","ofile="])
+        opts, args = getopt.getopt(argv,"hi:o:w:s:p:t:",["ifile=","ofile=","window=","step=","processes=","threads="])
     except getopt.GetoptError:
         print("\nNot a valid argument")
-        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file> [-w <window size> -s <step size>] [-p <number of processes>]\n")
         sys.exit(2)        
     for opt, arg in opts:
         if opt == "-h":
-            print("\nget_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+            print("\nget_gc_content.py -i <fasta format input file> -o <tab delimited output file> [-w <window size> -s <step size>] [-p <number of processes>]\n")
             sys.exit()
         elif opt in ("-i", "--ifile"):
             in_file = arg
         elif opt in ("-o", "--ofile"):
             out_file = arg
+        elif opt in ("-w", "--window"):
+            window = arg
+        elif opt in ("-s", "--step"):
+            step = arg
+        elif opt in ("-p", "--processes", "-t", "--threads"):
+            processes = arg
+
+    try:
+        window = int(window)
+        step = int(step)
+        processes = int(processes)
+    except ValueError:
+        print("\nNot a valid window, step or process count: -w, -s and -p must be integers")
+        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file> [-w <window size> -s <step size>] [-p <number of processes>]\n")
+        sys.exit(2)
+    if step == 0:
+        step = window
+    if window < 0 or step < 0 or processes < 1:
+        print("\nNot a valid window, step or process count: -w and -s must be greater than 0, -p must be at least 1")
+        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file> [-w <window size> -s <step size>] [-p <number of processes>]\n")
+        sys.exit(2)
 
     #----------------------------------
     #Open Files for reading and writing
     #----------------------------------
     try:
-        IN = open(in_file,"r")
+        IN = open(in_file,"rb")
     except FileNotFoundError:
         print("\nFASTA Input File could not be found")
-        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file> [-w <window size> -s <step size>] [-p <number of processes>]\n")
         sys.exit(2)
     OUT = open(out_file,"w")
 
@@ -75,23 +147,22 @@ def main(argv):
     #---------------------------
     #Read and Process FASTA file
     #---------------------------
-    OUT.write("ID\t%GC Content\tTotal Count\tG Count\tC Count\tA Count\tT Count\n")
-    seq = ""
-    lines = IN.readlines()
-    for line in lines:
-        if re.search("^>",line):
-            if len(seq) > 0:
-                result = process_seq(seq)
-                OUT.write("%f\t%d\t%d\t%d\t%d\t%d\n" % (result[0],result[1],result[2],result[3],result[4],result[5]))
-                seq = ""
-            len_id = len(line)
-            chopped_id = line[1:len_id-1] #removing  the ">" and the "\n" from the ends of the header line
-            OUT.write(chopped_id + "\t")
-        else:
-            seq = seq + line
-    #process last record's sequence.
-    result = process_seq(seq)
-    OUT.write("%f\t%d\t%d\t%d\t%d\t%d\n" % (result[0],result[1],result[2],result[3],result[4],result[5]))
+    if window > 0:
+        write_windows(IN, OUT, window, step)
+    elif processes > 1:
+        #Split the file at record boundaries into more ranges than processes
+        #(and no bigger than SHARD_SIZE) so the work stays balanced, and write
+        #the ranges back in file order.
+        OUT.write("ID\t%GC Content\tTotal Count\tG Count\tC Count\tA Count\tT Count\tN Count\tAmbiguous Count\n")
+        shards = max(processes * 8, os.path.getsize(in_file) // SHARD_SIZE)
+        jobs = [(in_file, start, end) for start, end in record_ranges(in_file, shards)]
+        with Pool(processes) as pool:
+            for rows in pool.imap(process_range, jobs):
+                OUT.write(rows)
+    else:
+        OUT.write("ID\t%GC Content\tTotal Count\tG Count\tC Count\tA Count\tT Count\tN Count\tAmbiguous Count\n")
+        for header, seq in read_fasta(IN):
+            OUT.write(format_row(header, seq))
 
     #-----------
     #Close Files
@@ -2,6 +2,7 @@
 ##########################################################################################
 ### Get GC Content                                                                     ###
 ### Usage: get_gc_content_hist.py -i <fasta input file> -o <tab delimited output file> ###
+###        [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]                      ###
 ### This program reads a fasta file and returns a tab delimited file with:             ###
 ### column 1 = header (every thing between > and new line)                             ###
 ### column 2 = %gc content for the fasta entry                                         ###
@@ -10,6 +11,8 @@
 ### column 5 = total count of Cs (or cs)                                               ###
 ### column 6 = total count of As (or as)                                               ###
 ### column 7 = total count of Ts (or ts)                                               ###
+### column 8 = total count of Ns (or ns)                                               ###
+### column 9 = total count of other IUPAC ambiguity codes (R,Y,S,W,K,M,B,D,H,V)        ###
 ###                                                                                    ###
 ### Jennifer Meneghin                                                                  ###
 ### 01/20/2020                                                                         ###
@@ -21,28 +24,179 @@
 ### Jennifer Meneghin                                                                  ###
 ### 02/11/2020                                                                         ###
 ###                                                                                    ###
+### Update:                                                                            ###
+### -f <png or svg> saves the plots next to the output file (output.gc_histogram.png,  ###
+### output.nucleotide_counts.png) instead of displaying them, so the script can run    ###
+### on a cluster with no display.                                                      ###
+### -s (streaming mode) writes each row as soon as it is counted and only keeps a      ###
+### fixed number of %GC histogram bins (-b, default 10) and running summary            ###
+### statistics, so memory does not grow with the number of records. The summary is     ###
+### printed when the file is done and the histogram is saved (as png unless -f svg).   ###
+###                                                                                    ###
+### Update:                                                                            ###
+### -a (aggregated plots) replaces the one point per record line graph, which is       ###
+### unreadable and slow to draw for millions of records, with plots of binned data:    ###
+### a 2D density of sequence length vs %GC content (output.length_gc_density.png)      ###
+### and the mean A, C, G and T counts per sequence length bin                          ###
+### (output.nucleotide_counts.png). Lengths are binned on a log10 scale in steps of    ###
+### 0.1, so drawing time does not depend on the number of records. It works with       ###
+### and without -s.                                                                    ###
+###                                                                                    ###
+### Update:                                                                            ###
+### pandas and matplotlib are only imported when they are needed, and -t (table only)  ###
+### writes the tab delimited file and the summary without any plots, so it never       ###
+### loads pandas or matplotlib at all. This makes short runs (and -h) start quickly.   ###
+###                                                                                    ###
 ##########################################################################################
 
-import re, sys, getopt
-import pandas as pd
-import matplotlib.pyplot as plt
+import math, sys, getopt
+import numpy as np
+from seq_reader import read_fasta
+from composition import count_composition
+
+COLUMNS = ["%GC Content","Total Count","G Count","C Count","A Count","T Count","N Count","Ambiguous Count"]
+LENGTH_BINS = 100 #log10(sequence length) in steps of 0.1, from 1 bp to 10 Gbp
 
 #----------------
 #Process Sequence
 #----------------
 def process_seq(seq):
-    seq = seq.upper()
-    acount = len(re.findall("A",seq))
-    ccount = len(re.findall("C",seq))
-    gcount = len(re.findall("G",seq))
-    tcount = len(re.findall("T",seq))
+    composition = count_composition(seq)
+    acount = composition["A"]
+    ccount = composition["C"]
+    gcount = composition["G"]
+    tcount = composition["T"]
     gccount = ccount + gcount
-    totalcount = len(re.findall("[A-Z]",seq))
+    totalcount = composition["Total"]
     if totalcount > 0:
         gccontent = (100 * gccount) / totalcount
     else:
         gccontent = 0
-    return [gccontent, totalcount, gcount, ccount, acount, tcount]
+    return [gccontent, totalcount, gcount, ccount, acount, tcount, composition["N"], composition["Ambiguous"]]
+
+#------------------------------------------------
+#Save the current plot to plot_file, or display it
+#------------------------------------------------
+def finish_plot(plot_file):
+    import matplotlib.pyplot as plt
+    if plot_file:
+        plt.savefig(plot_file)
+        plt.close()
+        print("Saved plot: " + plot_file)
+    else:
+        plt.show()
+
+#-----------------------------------------------------------
+#Add one record's results to the running summary statistics
+#(Welford's method for the mean and variance of %GC Content)
+#-----------------------------------------------------------
+def update_summary(summary, result):
+    gccontent = result[0]
+    summary["Records"] += 1
+    summary["Total Count"] += result[1]
+    summary["GC Count"] += result[2] + result[3]
+    summary["Min %GC"] = min(summary["Min %GC"], gccontent)
+    summary["Max %GC"] = max(summary["Max %GC"], gccontent)
+    delta = gccontent - summary["Mean %GC"]
+    summary["Mean %GC"] += delta / summary["Records"]
+    summary["M2"] += delta * (gccontent - summary["Mean %GC"])
+
+#---------------------------------------------------------
+#Aggregated plot data: records per (length bin, %GC bin),
+#and records and A, C, G, T totals per length bin
+#---------------------------------------------------------
+def new_aggregate(bins):
+    return {"Density": np.zeros((LENGTH_BINS, bins), dtype=np.int64),
+            "Records": np.zeros(LENGTH_BINS, dtype=np.int64),
+            "Nucleotides": np.zeros((LENGTH_BINS, 4), dtype=np.int64)}
+
+def gc_bin(gccontent, bins):
+    return min(int(gccontent * bins / 100), bins - 1)
+
+def length_bin(length):
+    if length < 1:
+        return 0
+    return min(int(math.log10(length) * 10), LENGTH_BINS - 1)
+
+def update_aggregate(aggregate, result, bins):
+    row = length_bin(result[1])
+    aggregate["Density"][row, gc_bin(result[0], bins)] += 1
+    aggregate["Records"][row] += 1
+    aggregate["Nucleotides"][row] += (result[4], result[3], result[2], result[5])
+
+#-----------------------------------------------------
+#Create and Display (or Save) the Aggregated Plots:
+#length vs %GC density and binned nucleotide counts
+#-----------------------------------------------------
+def plot_aggregate(aggregate, bins, density_file, line_file):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    used = np.flatnonzero(aggregate["Records"])
+    if len(used) == 0:
+        return
+    low = used[0]
+    high = used[-1] + 1
+    length_edges = 10 ** (np.arange(low, high + 1) / 10)
+    gc_edges = np.linspace(0, 100, bins + 1)
+    density = np.ma.masked_equal(aggregate["Density"][low:high].T, 0)
+    plt.pcolormesh(length_edges, gc_edges, density, norm=LogNorm(vmin=1, vmax=max(2, density.max())))
+    plt.xscale('log')
+    plt.minorticks_off()
+    plt.colorbar(label='Records')
+    plt.xlabel('Sequence Length')
+    plt.ylabel('%GC Content')
+    plt.title('Sequence Length vs GC Content')
+    finish_plot(density_file)
+
+    records = aggregate["Records"][low:high]
+    keep = records > 0
+    centers = 10 ** ((np.arange(low, high) + 0.5) / 10)
+    means = aggregate["Nucleotides"][low:high][keep] / records[keep, None]
+    for i, base in enumerate("ACGT"):
+        plt.plot(centers[keep], means[:, i], label=base)
+    plt.xscale('log')
+    plt.minorticks_off()
+    plt.xlabel('Sequence Length')
+    plt.ylabel('Mean Count')
+    plt.title('Nucleotide Counts')
+    plt.legend(loc='upper left')
+    finish_plot(line_file)
+
+#---------------------------------------------------------------
+#Streaming mode: write each row as it is counted, and keep only
+#the %GC histogram bins and the summary statistics in memory
+#---------------------------------------------------------------
+def stream_gc(IN, out_file, bins, aggregate=None):
+    OUT = open(out_file,"w")
+    OUT.write("\t" + "\t".join(COLUMNS) + "\n")
+    histogram = [0] * bins
+    summary = {"Records": 0, "Total Count": 0, "GC Count": 0, "Min %GC": 100.0, "Max %GC": 0.0, "Mean %GC": 0.0, "M2": 0.0}
+    for hid, seq in read_fasta(IN):
+        result = process_seq(seq)
+        OUT.write(hid.decode() + "\t" + "\t".join([repr(float(i)) for i in result]) + "\n")
+        histogram[gc_bin(result[0], bins)] += 1
+        update_summary(summary, result)
+        if aggregate is not None:
+            update_aggregate(aggregate, result, bins)
+    OUT.close()
+    return histogram, summary
+
+#----------------------------
+#Print the summary statistics
+#----------------------------
+def print_summary(summary):
+    records = summary["Records"]
+    print("Number of Fasta Entries = " + str(records))
+    if records == 0:
+        return
+    print("Total Count = " + str(summary["Total Count"]))
+    print("Average Sequence Length = " + str(summary["Total Count"] / records))
+    if summary["Total Count"] > 0:
+        print("Overall %GC Content = " + str(100 * summary["GC Count"] / summary["Total Count"]))
+    print("Mean %GC Content = " + str(summary["Mean %GC"]))
+    print("Standard Deviation %GC Content = " + str((summary["M2"] / records) ** 0.5))
+    print("Min %GC Content = " + str(summary["Min %GC"]))
+    print("Max %GC Content = " + str(summary["Max %GC"]))
 
 #--------------
 #The Main Event
@@ -54,72 +208,130 @@ def main(argv):
     #---------------------------
     in_file = ""
     out_file = "gc_out.txt"
+    stream = False
+    table_only = False
+    aggregated = False
+    bins = 10
+    plot_format = ""
     try:
-        opts, args = getopt.getopt(argv,"hi:o:",["ifile=","ofile="])
+        opts, args = getopt.getopt(argv,"hi:o:satb:f:",["ifile=","ofile=","stream","aggregate","table-only","bins=","format="])
     except getopt.GetoptError:
         print("\nNot a valid argument")
-        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+        print("get_gc_content_hist.py -i <fasta format input file> -o <tab delimited output file> [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]\n")
         sys.exit(2)        
     for opt, arg in opts:
         if opt == "-h":
-            print("\nget_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+            print("\nget_gc_content_hist.py -i <fasta format input file> -o <tab delimited output file> [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]\n")
             sys.exit()
         elif opt in ("-i", "--ifile"):
             in_file = arg
         elif opt in ("-o", "--ofile"):
             out_file = arg
+        elif opt in ("-s", "--stream"):
+            stream = True
+        elif opt in ("-a", "--aggregate"):
+            aggregated = True
+        elif opt in ("-t", "--table-only"):
+            table_only = True
+        elif opt in ("-b", "--bins"):
+            bins = arg
+        elif opt in ("-f", "--format"):
+            plot_format = arg
+
+    try:
+        bins = int(bins)
+    except ValueError:
+        bins = 0
+    if bins < 1:
+        print("\nNot a valid number of bins: -b must be an integer greater than 0")
+        print("get_gc_content_hist.py -i <fasta format input file> -o <tab delimited output file> [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]\n")
+        sys.exit(2)
+    if stream and not table_only and not plot_format:
+        plot_format = "png"
+    if plot_format not in ("", "png", "svg"):
+        print("\nNot a valid plot format: -f must be png or svg. You entered: " + plot_format)
+        print("get_gc_content_hist.py -i <fasta format input file> -o <tab delimited output file> [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]\n")
+        sys.exit(2)
+    if plot_format and not table_only:
+        import matplotlib
+        matplotlib.use("Agg")
 
     #---------------------
     #Open File for reading
     #---------------------
     try:
-        IN = open(in_file,"r")
+        IN = open(in_file,"rb")
     except FileNotFoundError:
         print("\nFASTA Input File could not be found")
-        print("get_gc_content.py -i <fasta format input file> -o <tab delimited output file>\n")
+        print("get_gc_content_hist.py -i <fasta format input file> -o <tab delimited output file> [-s] [-a] [-t] [-b <number of bins>] [-f <png or svg>]\n")
         sys.exit(2)
 
+    hist_file = ""
+    line_file = ""
+    density_file = ""
+    if plot_format:
+        hist_file = out_file + ".gc_histogram." + plot_format
+        line_file = out_file + ".nucleotide_counts." + plot_format
+        density_file = out_file + ".length_gc_density." + plot_format
+    aggregate = new_aggregate(bins) if aggregated and not table_only else None
+
+    #-----------------------------------------------------------
+    #Table only and Streaming modes: Process FASTA file one row
+    #at a time (and Save Histogram)
+    #-----------------------------------------------------------
+    if table_only or stream:
+        histogram, summary = stream_gc(IN, out_file, bins, aggregate)
+        IN.close()
+        print_summary(summary)
+        if table_only:
+            return
+        import matplotlib.pyplot as plt
+        edges = [100 * i / bins for i in range(bins + 1)]
+        plt.hist(edges[:-1], bins=edges, weights=histogram)
+        plt.title('GC Content Histogram')
+        finish_plot(hist_file)
+        if aggregated:
+            plot_aggregate(aggregate, bins, density_file, line_file)
+        return
+
     #---------------------------
     #Read and Process FASTA file
     #---------------------------
-    seq = ""
-    lines = IN.readlines()
+    import matplotlib.pyplot as plt
     gcresults = {}
-    for line in lines:
-        if re.search("^>",line):
-            if len(seq) > 0:
-                gcresults[hid] = process_seq(seq)
-                seq = ""
-            hid = line[1:len(line)-1]
-        else:
-            seq = seq + line
-    gcresults[hid] = process_seq(seq)
+    for hid, seq in read_fasta(IN):
+        gcresults[hid.decode()] = process_seq(seq)
 
     #---------------------
     #Write results to file
     #---------------------
-    df = pd.DataFrame(gcresults,index=["%GC Content","Total Count","G Count","C Count","A Count","T Count"])
+    import pandas as pd
+    df = pd.DataFrame(gcresults,index=COLUMNS)
     df.T.to_csv(out_file,sep='\t')
     IN.close()
 
     #---------------------------------
     #Create and Display Histogram Plot
     #---------------------------------
-    plt.hist(df.loc['%GC Content'])
+    plt.hist(df.loc['%GC Content'], bins=bins)
     plt.title('GC Content Histogram')
-    plt.show()
+    finish_plot(hist_file)
 
-    #-----------------------------
-    #Create and Display Line Graph
-    #-----------------------------
+    #---------------------------------------------------
+    #Create and Display Aggregated Plots (or Line Graph)
+    #---------------------------------------------------
+    if aggregated:
+        for result in gcresults.values():
+            update_aggregate(aggregate, result, bins)
+        plot_aggregate(aggregate, bins, density_file, line_file)
+        return
     plt.plot(df.loc['A Count'], label='A')
     plt.plot(df.loc['C Count'], label='C')
     plt.plot(df.loc['G Count'], label='G')
     plt.plot(df.loc['T Count'], label='T')
     plt.title('Nucleotide Counts')
     plt.legend(loc='upper right', bbox_to_anchor=(1.1,1.0))
-    plt.show()
+    finish_plot(line_file)
     
 if __name__ == "__main__":
     main(sys.argv[1:])
-
@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 ###################################################################################
 ### Get kmer Frequencies                                                        ###
-### Usage: get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length> ###
+### Usage: get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> ###
 ### This program takes a fasta file, k and a prefix as it's parameters.         ###
 ###                                                                             ###
 ### It returns a tab delimited file of kmer counts.                             ###
@@ -10,53 +10,437 @@
 ### Jennifer Meneghin                                                           ###
 ### Original Perl Code: 05/11/2015                                              ###
 ### 01/28/2020                                                                  ###
+###                                                                             ###
+### Update:                                                                     ###
+### Each sequence is 2-bit encoded into a NumPy array (A=0, C=1, G=2, T=3) and  ###
+### the forward and reverse complement codes of every k-mer are built with     ###
+### shifts, so the canonical k-mer is the smaller number. They are counted     ###
+### with bincount (or unique when 4^k is large). k-mers that contain anything  ###
+### other than A, C, G or T are still counted as strings, as before, and k     ###
+### over 31 (too big for 64 bits) falls back to strings too.                   ###
+###                                                                             ###
+### Update:                                                                     ###
+### The counts are kept as a sparse records x kmers matrix. -f sets the output  ###
+### format: tsv (the tab delimited table, as before), mtx (Matrix Market, with  ###
+### the record and kmer names in prefix_kmers_records.txt and                  ###
+### prefix_kmers_kmers.txt) or npz (a compressed NumPy archive that            ###
+### scipy.sparse.load_npz can read, with the names included).                  ###
+###                                                                             ###
+### Update:                                                                     ###
+### -n <number of processes> counts batches of records in worker processes.    ###
+### Each worker returns the counts of its batch as one block of arrays, and    ###
+### the blocks are added in input order, so the output is the same as with    ###
+### one process.                                                               ###
+###                                                                             ###
+### Update:                                                                     ###
+### -k takes a list and/or range of lengths (e.g. 1-6 or 2,4,8). The file is    ###
+### read once and each sequence is encoded once: the codes of the longest k    ###
+### are built, and every shorter k-mer is the front of a longer one (a shift   ###
+### of the forward code and a mask of the reverse complement code). Each k is  ###
+### written to its own prefix_<k>mers file.                                    ###
+###                                                                             ###
+### Update:                                                                     ###
+### -a counts approximately, in bounded memory, for k up to 31: the canonical  ###
+### k-mers go into a count-min sketch (-e sets the error as a fraction of all  ###
+### k-mers counted, -m caps the sketch size in MB), and a HyperLogLog          ###
+### estimates the distinct k-mers of each record and of the whole file.       ###
+### -q <file> looks up the estimated count of each k-mer in the file.         ###
 ###################################################################################
 
-import re, sys, getopt
+import sys, getopt
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+from seq_reader import read_fasta, batch_records, ordered_map
+
+#2-bit code of each byte value (4 = not A, C, G or T)
+CODE = np.full(256, 4, dtype=np.uint8)
+CODE[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+LETTERS = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+#Longest k that fits in 64 bit codes
+MAX_CODED_K = 31
+#Count with bincount when 4^k is at most this (or the number of k-mers)
+DENSE_SIZE = 1 << 16
+#Table cells filled at a time when writing the tab delimited table
+TSV_BLOCK = 1 << 22
+FORMATS = ("tsv", "mtx", "npz")
+#Rows of the count-min sketch (the error bound holds with probability
+#1 - e^-CMS_DEPTH) and HyperLogLog register bits (2^HLL_BITS registers)
+CMS_DEPTH = 5
+HLL_BITS = 12
+SETTINGS = {}
 
 def usage ():
     usage = "\nGet kmer Frequencies\n"
-    usage = usage + "\nUsage: get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length>\n"
+    usage = usage + "\nUsage: get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n"
     usage = usage + "\nThis program takes a fasta file, k and prefix as it's parameters.\n\n"
     usage = usage + "It returns a tab delimited file (prefix_kmers.txt) of kmer counts. (columns = records, rows = kmer counts.)\n\n"
+    usage = usage + "With -f mtx the counts are written as a sparse Matrix Market file (prefix_kmers.mtx, rows = records,\n"
+    usage = usage + "columns = kmers) with the names in prefix_kmers_records.txt and prefix_kmers_kmers.txt.\n"
+    usage = usage + "With -f npz they are written as a compressed NumPy archive (prefix_kmers.npz) that\n"
+    usage = usage + "scipy.sparse.load_npz can read, with the names in its \"records\" and \"kmers\" arrays.\n\n"
+    usage = usage + "-k can be a list and/or range of lengths (e.g. -k 1-6 or -k 2,4,8). The file is read once\n"
+    usage = usage + "and each k is written to its own file, named prefix_<k>mers instead of prefix_kmers.\n\n"
+    usage = usage + "With -a (k up to 31) the counts are approximate and use bounded memory. The k-mers go\n"
+    usage = usage + "into a count-min sketch whose counts are over by at most -e times the k-mers counted (default\n"
+    usage = usage + "0.000001) with probability 0.993, but no more than -m MB (default 256) is used for the sketches.\n"
+    usage = usage + "prefix_kmers_approx.txt gets the k-mers and estimated distinct k-mers of each record, and\n"
+    usage = usage + "prefix_kmers_summary.txt the totals. -q <file> (one k-mer per line) writes the estimated\n"
+    usage = usage + "count of each k-mer to prefix_kmers_queries.txt.\n\n"
     usage = usage + "Jennifer Meneghin\n"
     usage = usage + "Janurary 28, 2020\n\n"
     return usage
 
 def rc_seq(mykmer, k):
-    rcmykmer = ""
-    i = int(k)-1
-    while i >= 0:
-        if mykmer[i] == "A":
-            rcmykmer = rcmykmer + "T"
-        elif mykmer[i] == "C":
-            rcmykmer = rcmykmer + "G"
-        elif mykmer[i] == "G":
-            rcmykmer = rcmykmer + "C"
-        elif mykmer[i] == "T":
-            rcmykmer = rcmykmer + "A"
-        else:
-            rcmykmer = rcmykmer + mykmer[i]
-        i = i - 1
-    return rcmykmer
-
-def process_it(knucs, seq, k, header):
-    i = 0
-    seq = seq + seq[0:int(k)-1] #Tack the first kmer onto the end to get the wrap around kmers
-    end = len(seq) - int(k) + 1
-    while i < end:
-        thiskmer = seq[i:i+int(k)]
-        i+=1
-        rckmer = rc_seq(thiskmer,k)
-        if thiskmer <= rckmer:
-            key = header + "\t" + thiskmer
-        else:
-            key = header + "\t" + rckmer
-        if key in knucs:
-            knucs[key] = knucs[key] + 1
+    return mykmer[int(k)-1::-1].translate(COMPLEMENT)
+
+#-------------------------------------------------------------------
+#Find the canonical k-mers of one upper case sequence for each k in
+#ks, including the wrap around k-mers (the first k-1 bases are tacked
+#onto the end). Returns a list with (canonical, other) for each k:
+#the 2-bit codes of the ACGT k-mers, one per position (None when k is
+#over MAX_CODED_K), and a Counter of the k-mers with any other letter
+#in them.
+#-------------------------------------------------------------------
+def canonical_kmers(seq, ks):
+    found_kmers = {}
+    coded = [k for k in ks if k <= MAX_CODED_K]
+    for k in ks:
+        if k > MAX_CODED_K:
+            wrapped = seq + seq[0:k-1]
+            found_kmers[k] = (None, Counter([min(wrapped[i:i+k], rc_seq(wrapped[i:i+k], k)) for i in range(len(wrapped) - k + 1)]))
+    #When the sequence is at least k-1 long for the longest k, every k has
+    #one k-mer per base and the shorter k-mers are the fronts of the longer
+    #ones. Otherwise the wrap around differs, and each k is done on its own.
+    if coded and len(seq) >= max(coded) - 1:
+        groups = [coded]
+    else:
+        groups = [[k] for k in coded]
+    for group in groups:
+        longest = max(group)
+        wrapped = seq + seq[0:longest-1]
+        end = len(wrapped) - longest + 1
+        if end <= 0:
+            for k in group:
+                found_kmers[k] = (np.zeros(0, dtype=np.uint64), Counter())
+            continue
+        codes = CODE[np.frombuffer(wrapped.encode("ascii", "replace"), dtype=np.uint8)]
+        forward = np.zeros(end, dtype=np.uint64)
+        reverse = np.zeros(end, dtype=np.uint64)
+        for j in range(longest):
+            base = codes[j:j+end].astype(np.uint64) & np.uint64(3)
+            forward <<= np.uint64(2)
+            forward |= base
+            reverse |= (np.uint64(3) - base) << np.uint64(2 * j)
+        invalid = codes == 4
+        found = None
+        if invalid.any():
+            found = np.zeros(len(codes) + 1, dtype=np.int64)
+            np.cumsum(invalid, out=found[1:])
+        for k in group:
+            canonical = np.minimum(forward >> np.uint64(2 * (longest - k)), reverse & np.uint64((1 << (2 * k)) - 1))
+            other = Counter()
+            if found is not None:
+                mixed = (found[k:k+end] - found[:end]) > 0
+                for i in np.flatnonzero(mixed).tolist():
+                    other[min(wrapped[i:i+k], rc_seq(wrapped[i:i+k], k))] += 1
+                canonical = canonical[~mixed]
+            found_kmers[k] = (canonical, other)
+    return [found_kmers[k] for k in ks]
+
+#-------------------------------------------------------------------
+#Count the canonical k-mers of one upper case sequence for each k in
+#ks. Returns a list with (codes, counts, other) for each k: the codes
+#of the ACGT k-mers found and their counts, as NumPy arrays sorted by
+#code, and the Counter of the other k-mers.
+#-------------------------------------------------------------------
+def kmer_profiles(seq, ks):
+    profiles = []
+    for k, (canonical, other) in zip(ks, canonical_kmers(seq, ks)):
+        if canonical is None:
+            profiles.append((np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), other))
         else:
-            knucs[key] = 1
-    return knucs
+            profiles.append(count_codes(canonical, k) + (other,))
+    return profiles
+
+#Count k-mer codes with bincount when 4^k is small, otherwise unique.
+#Returns (codes, counts), sorted by code.
+def count_codes(canonical, k):
+    if 4 ** k <= max(DENSE_SIZE, len(canonical)):
+        counts = np.bincount(canonical.astype(np.int64), minlength=4 ** k)
+        kmers = np.flatnonzero(counts)
+        return kmers.astype(np.uint64), counts[kmers]
+    kmers, counts = np.unique(canonical, return_counts=True)
+    return kmers, counts.astype(np.int64)
+
+#Turn 2-bit k-mer codes back into strings
+def decode_kmers(kmers, k):
+    letters = np.empty((len(kmers), k), dtype=np.uint8)
+    for j in range(k):
+        letters[:, j] = LETTERS[((kmers >> np.uint64(2 * (k - 1 - j))) & np.uint64(3)).astype(np.int64)]
+    return [kmer.decode() for kmer in letters.view("S" + str(k)).ravel().tolist()]
+
+#-----------------------------------------------------------------
+#The counts of every record so far: a number for each header, and
+#the coded k-mer counts of each record as arrays, plus the counts of
+#k-mers that are kept as strings by (record number, kmer)
+#-----------------------------------------------------------------
+def new_profiles():
+    return {"records": {}, "record": [], "kmers": [], "counts": [], "other": Counter()}
+
+#Settings used by profile_batch (set once in every worker process)
+def init_profile(ks):
+    SETTINGS["ks"] = ks
+
+#-------------------------------------------------------------------
+#Count the k-mers of a batch of (header, sequence) records. Returns
+#one block for each k: (headers, record, kmers, counts, other), where
+#record gives the position in the batch of each (kmer, count) and
+#other holds each record's Counter of string k-mers.
+#-------------------------------------------------------------------
+def profile_batch(batch):
+    ks = SETTINGS["ks"]
+    headers = [header.rstrip() for header, seq in batch]
+    parts = [([], [], [], []) for k in ks]
+    for i, (header, seq) in enumerate(batch):
+        for (record, kmers, counts, other), (codes, code_counts, strings) in zip(parts, kmer_profiles(seq.upper(), ks)):
+            record.append(np.full(len(codes), i, dtype=np.int64))
+            kmers.append(codes)
+            counts.append(code_counts)
+            other.append(strings)
+    return [(headers, np.concatenate(record), np.concatenate(kmers), np.concatenate(counts), other) for record, kmers, counts, other in parts]
+
+#Add a block from profile_batch to the profiles
+def add_block(profiles, block):
+    headers, record, kmers, counts, other = block
+    numbers = np.array([profiles["records"].setdefault(header, len(profiles["records"])) for header in headers], dtype=np.int64)
+    if len(kmers):
+        profiles["record"].append(numbers[record])
+        profiles["kmers"].append(kmers)
+        profiles["counts"].append(counts)
+    for number, strings in zip(numbers.tolist(), other):
+        for kmer, count in strings.items():
+            profiles["other"][number, kmer] += count
+    return profiles
+
+#----------------------------------------------------------------------
+#Turn the profiles into a sparse matrix. Returns (record names, kmer
+#names, rows, columns, counts): the names are sorted, only records with
+#at least one k-mer are kept, and a header found more than once has its
+#counts added together. The entries are sorted by row, then column.
+#----------------------------------------------------------------------
+def build_matrix(profiles, k):
+    empty = np.zeros(0, dtype=np.int64)
+    record = np.concatenate(profiles["record"] + [empty])
+    counts = np.concatenate(profiles["counts"] + [empty])
+    codes, inverse = np.unique(np.concatenate(profiles["kmers"] + [empty.astype(np.uint64)]), return_inverse=True)
+    code_names = decode_kmers(codes, k)
+    kmer_names = sorted(set(code_names) | set([kmer for number, kmer in profiles["other"]]))
+    kmer_index = dict([(kmer, i) for i, kmer in enumerate(kmer_names)])
+    column = np.array([kmer_index[kmer] for kmer in code_names], dtype=np.int64)[inverse.ravel()]
+    if profiles["other"]:
+        other = list(profiles["other"].items())
+        record = np.append(record, [number for (number, kmer), count in other])
+        column = np.append(column, [kmer_index[kmer] for (number, kmer), count in other])
+        counts = np.append(counts, [count for key, count in other])
+    headers = dict([(number, header) for header, number in profiles["records"].items()])
+    used = np.unique(record)
+    record_names = sorted([headers[number] for number in used.tolist()])
+    record_index = dict([(header, i) for i, header in enumerate(record_names)])
+    row_of = np.zeros(len(profiles["records"]), dtype=np.int64)
+    row_of[used] = [record_index[headers[number]] for number in used.tolist()]
+    keys, inverse = np.unique(row_of[record] * len(kmer_names) + column, return_inverse=True)
+    totals = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(totals, inverse.ravel(), counts)
+    return record_names, kmer_names, keys // max(len(kmer_names), 1), keys % max(len(kmer_names), 1), totals
+
+#--------------------------------------------------------------------
+#Write the tab delimited table (rows = kmers, columns = records). The
+#table is filled in blocks of kmers so only TSV_BLOCK cells are held.
+#--------------------------------------------------------------------
+def write_tsv(OUT, k, prefix, record_names, kmer_names, rows, columns, counts):
+    OUT.write(str(k)+"-mer")
+    for record in record_names:
+        OUT.write("\t"+str(prefix)+"_"+str(record))
+    OUT.write("\n")
+    order = np.lexsort((rows, columns))
+    rows, columns, counts = rows[order], columns[order], counts[order]
+    per_block = max(1, TSV_BLOCK // max(len(record_names), 1))
+    bounds = np.searchsorted(columns, np.arange(0, len(kmer_names) + per_block, per_block))
+    for block, first in enumerate(range(0, len(kmer_names), per_block)):
+        names = kmer_names[first:first+per_block]
+        table = np.zeros((len(names), len(record_names)), dtype=np.int64)
+        start, end = bounds[block], bounds[block+1]
+        table[columns[start:end] - first, rows[start:end]] = counts[start:end]
+        OUT.write("".join([kmer + "\t" + "\t".join(map(str, line)) + "\n" for kmer, line in zip(names, table.tolist())]))
+
+#--------------------------------------------------------------
+#Write a Matrix Market coordinate file (rows = records, columns
+#= kmers, 1 based) to out_name.mtx, and the record and kmer names
+#to out_name_records.txt and out_name_kmers.txt
+#--------------------------------------------------------------
+def write_mtx(out_name, prefix, record_names, kmer_names, rows, columns, counts):
+    with open(out_name+".mtx", "w") as OUT:
+        OUT.write("%%MatrixMarket matrix coordinate integer general\n")
+        OUT.write("%rows = records ("+out_name+"_records.txt), columns = kmers ("+out_name+"_kmers.txt)\n")
+        OUT.write(str(len(record_names))+" "+str(len(kmer_names))+" "+str(len(counts))+"\n")
+        for first in range(0, len(counts), TSV_BLOCK):
+            block = np.column_stack((rows[first:first+TSV_BLOCK] + 1, columns[first:first+TSV_BLOCK] + 1, counts[first:first+TSV_BLOCK]))
+            OUT.write("".join(["%d %d %d\n" % tuple(entry) for entry in block.tolist()]))
+    with open(out_name+"_records.txt", "w") as NAMES:
+        NAMES.write("".join([str(prefix)+"_"+record+"\n" for record in record_names]))
+    with open(out_name+"_kmers.txt", "w") as NAMES:
+        NAMES.write("".join([kmer+"\n" for kmer in kmer_names]))
+
+#--------------------------------------------------------------------
+#Write a compressed NumPy archive in the layout scipy.sparse.save_npz
+#uses for a COO matrix, plus the record and kmer names
+#--------------------------------------------------------------------
+def write_npz(out_file, prefix, record_names, kmer_names, rows, columns, counts):
+    np.savez_compressed(out_file, format=np.array(b"coo"), shape=np.array([len(record_names), len(kmer_names)]), row=rows, col=columns, data=counts,
+        records=np.array([str(prefix)+"_"+record for record in record_names], dtype=str), kmers=np.array(kmer_names, dtype=str))
+
+#------------------------------------------------------------
+#Scramble 64 bit codes (the splitmix64 finalizer), with a
+#different result for each seed
+#------------------------------------------------------------
+def mix64(codes, seed):
+    z = codes + np.uint64((seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+#Number of bits needed for each value (0 for 0)
+def bit_length(values):
+    values = values.copy()
+    bits = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = values >= np.uint64(1 << shift)
+        bits[big] += shift
+        values[big] >>= np.uint64(shift)
+    return bits + (values > 0)
+
+#----------------------------------------------------------------
+#HyperLogLog registers for a set of k-mer codes: the first
+#HLL_BITS of each hash pick a register, which keeps the longest
+#run of leading zeros (plus one) seen in the rest of the hash
+#----------------------------------------------------------------
+def hll_registers(codes):
+    registers = np.zeros(1 << HLL_BITS, dtype=np.uint8)
+    if len(codes):
+        hashes = mix64(codes, 0)
+        rest = 64 - HLL_BITS
+        ranks = rest + 1 - bit_length(hashes & np.uint64((1 << rest) - 1))
+        np.maximum.at(registers, (hashes >> np.uint64(rest)).astype(np.int64), ranks.astype(np.uint8))
+    return registers
+
+#Distinct values estimated from HyperLogLog registers
+def hll_estimate(registers):
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * np.log(m / zeros)
+    return float(estimate)
+
+#------------------------------------------------------------------
+#Count the k-mers of a batch of (header, sequence) records for the
+#sketches. Returns one block for each k: (headers, totals, skipped,
+#distinct, kmers, counts, registers): the ACGT k-mers in each record,
+#the k-mers skipped because they have other letters, the estimated
+#distinct k-mers in each record, the codes and counts of the whole
+#batch, and the batch's HyperLogLog registers.
+#------------------------------------------------------------------
+def sketch_batch(batch):
+    ks = SETTINGS["ks"]
+    headers = [header.rstrip() for header, seq in batch]
+    parts = [([], [], [], []) for k in ks]
+    for header, seq in batch:
+        for (totals, skipped, distinct, kmers), (canonical, other) in zip(parts, canonical_kmers(seq.upper(), ks)):
+            totals.append(len(canonical))
+            skipped.append(sum(other.values()))
+            distinct.append(hll_estimate(hll_registers(canonical)))
+            kmers.append(canonical)
+    blocks = []
+    for k, (totals, skipped, distinct, kmers) in zip(ks, parts):
+        kmers = np.concatenate(kmers)
+        blocks.append((headers, totals, skipped, distinct) + count_codes(kmers, k) + (hll_registers(kmers),))
+    return blocks
+
+#Columns of each k-mer code in the rows of a count-min sketch
+def sketch_columns(kmers, width):
+    return [(mix64(kmers, row + 1) % np.uint64(width)).astype(np.int64) for row in range(CMS_DEPTH)]
+
+#Add k-mer counts to a count-min sketch
+def add_to_sketch(sketch, kmers, counts):
+    for row, columns in zip(sketch, sketch_columns(kmers, sketch.shape[1])):
+        np.add.at(row, columns, counts.astype(sketch.dtype))
+
+#Estimated counts of k-mer codes (never less than the true count)
+def query_sketch(sketch, kmers):
+    return np.min([row[columns] for row, columns in zip(sketch, sketch_columns(kmers, sketch.shape[1]))], axis=0)
+
+#Canonical 2-bit code of a k-mer string, or None when it has a letter other than A, C, G or T
+def kmer_code(kmer):
+    forward = 0
+    reverse = 0
+    for j, letter in enumerate(kmer):
+        if letter not in "ACGT":
+            return None
+        base = "ACGT".index(letter)
+        forward = (forward << 2) | base
+        reverse |= (3 - base) << (2 * j)
+    return min(forward, reverse)
+
+#----------------------------------------------------------------------
+#Approximate counting: stream the batches into a count-min sketch and
+#HyperLogLog registers for each k, writing the per record table as the
+#records come in (out_name_approx.txt), then the summary
+#(out_name_summary.txt) and any queries (out_name_queries.txt).
+#----------------------------------------------------------------------
+def sketch_counts(blocks, ks, out_names, prefix, epsilon, memory, queries):
+    width = int(min(np.ceil(np.e / epsilon), max(1, memory * 1048576 // (8 * CMS_DEPTH * len(ks)))))
+    sketches = [np.zeros((CMS_DEPTH, width), dtype=np.uint64) for k in ks]
+    registers = [np.zeros(1 << HLL_BITS, dtype=np.uint8) for k in ks]
+    totals = [0 for k in ks]
+    skipped = [0 for k in ks]
+    TABLES = [open(out_name+"_approx.txt", "w") for out_name in out_names]
+    for TABLE in TABLES:
+        TABLE.write("Record\tk-mers\tSkipped k-mers\tDistinct k-mers (estimated)\n")
+    pc = 0
+    for block in blocks:
+        for i, (headers, record_totals, record_skipped, distinct, kmers, counts, batch_registers) in enumerate(block):
+            add_to_sketch(sketches[i], kmers, counts)
+            np.maximum(registers[i], batch_registers, out=registers[i])
+            totals[i] += sum(record_totals)
+            skipped[i] += sum(record_skipped)
+            TABLES[i].write("".join([str(prefix)+"_"+header+"\t"+str(total)+"\t"+str(skip)+"\t"+str(int(round(estimate)))+"\n" for header, total, skip, estimate in zip(headers, record_totals, record_skipped, distinct)]))
+        for j in range(pc // 100 + 1, (pc + len(block[0][0])) // 100 + 1):
+            print("record count = "+str(j * 100))
+        pc += len(block[0][0])
+    for TABLE in TABLES:
+        TABLE.close()
+    for i, (k, out_name) in enumerate(zip(ks, out_names)):
+        distinct = hll_estimate(registers[i])
+        summary = str(k)+"-mers counted = "+str(totals[i])+"\n"
+        summary = summary + "k-mers skipped (letters other than A, C, G and T) = "+str(skipped[i])+"\n"
+        summary = summary + "Distinct "+str(k)+"-mers (estimated) = "+str(int(round(distinct)))+"\n"
+        summary = summary + "Mean count per distinct "+str(k)+"-mer (estimated) = "+str(totals[i] / distinct if distinct else 0)+"\n"
+        summary = summary + "Count-min sketch = "+str(CMS_DEPTH)+" x "+str(width)+" ("+str(sketches[i].nbytes)+" bytes)\n"
+        summary = summary + "Counts are over by at most "+str(np.e / width)+" x "+str(totals[i])+" = "+str(np.e / width * totals[i])+" with probability "+str(1 - np.exp(-CMS_DEPTH))+"\n"
+        print(summary)
+        with open(out_name+"_summary.txt", "w") as SUMMARY:
+            SUMMARY.write(summary)
+        if queries is not None:
+            with open(out_name+"_queries.txt", "w") as QUERIES:
+                QUERIES.write("kmer\tCanonical kmer\tEstimated count\n")
+                for kmer in queries:
+                    code = kmer_code(kmer) if len(kmer) == k else None
+                    if code is None:
+                        continue
+                    estimate = int(query_sketch(sketches[i], np.array([code], dtype=np.uint64))[0])
+                    QUERIES.write(kmer+"\t"+decode_kmers(np.array([code], dtype=np.uint64), k)[0]+"\t"+str(estimate)+"\n")
 
 def main(argv):
     #---------------------------
@@ -65,11 +449,17 @@ def main(argv):
     in_file = ""
     k = 4
     prefix = "My"
+    out_format = "tsv"
+    processes = 1
+    approximate = False
+    epsilon = 1e-6
+    memory = 256
+    query_file = None
     try:
-        opts, args = getopt.getopt(argv,"hi:k:p:",["ifile=","kint=","pstr="])
+        opts, args = getopt.getopt(argv,"hi:k:p:f:n:ae:m:q:",["ifile=","kint=","pstr=","format=","processes=","approximate","error=","memory=","queries="])
     except getopt.GetoptError:
         print("\nNot a valid argument or value")
-        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length>\n")
+        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n")
         sys.exit(2)
     for opt, arg in opts:
         if opt == "-h":
@@ -81,6 +471,37 @@ def main(argv):
             k = arg
         elif opt in ("-p", "--pstr"):
             prefix = arg
+        elif opt in ("-f", "--format"):
+            out_format = arg
+        elif opt in ("-n", "--processes"):
+            processes = arg
+        elif opt in ("-a", "--approximate"):
+            approximate = True
+        elif opt in ("-e", "--error"):
+            epsilon = arg
+        elif opt in ("-m", "--memory"):
+            memory = arg
+        elif opt in ("-q", "--queries"):
+            query_file = arg
+    try:
+        ks = set()
+        for part in str(k).split(","):
+            first, dash, last = part.partition("-")
+            ks.update(range(int(first), int(last if dash else first) + 1))
+        ks = sorted(ks)
+        processes = int(processes)
+        epsilon = float(epsilon)
+        memory = float(memory)
+    except ValueError:
+        ks = [0]
+    if not ks or ks[0] < 1 or processes < 1 or out_format not in FORMATS or not 0 < epsilon < 1 or memory <= 0:
+        print("\nNot a valid value: -k and -n must be whole numbers of 1 or more, -f one of "+", ".join(FORMATS)+", -e between 0 and 1 and -m more than 0")
+        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n")
+        sys.exit(2)
+    if approximate and ks[-1] > MAX_CODED_K:
+        print("\nNot a valid value: -a counts k of "+str(MAX_CODED_K)+" or less")
+        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n")
+        sys.exit(2)
 
     #----------------------------------
     #Open Files for reading and writing
@@ -89,77 +510,79 @@ def main(argv):
         IN = open(in_file,"r")
     except FileNotFoundError:
         print("\nFASTA Input File could not be found")
-        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length>\n")
+        print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n")
         sys.exit(2)
+    queries = None
+    if query_file is not None:
+        try:
+            with open(query_file) as QUERIES:
+                queries = [line.strip().upper() for line in QUERIES if line.strip()]
+        except FileNotFoundError:
+            print("\nQuery File could not be found")
+            print("get_kmer_frequencies.pl -i <fasta file> -p <prefix> -k <kmer length(s)> [-f tsv|mtx|npz] [-n <number of processes>] [-a [-e <error>] [-m <sketch MB>] [-q <kmer file>]]\n")
+            sys.exit(2)
 
-    out_file = prefix + "_kmers.txt";
-    OUT = open(out_file,"w")
+    if len(ks) == 1:
+        out_names = [prefix + "_kmers"]
+    else:
+        out_names = [prefix + "_" + str(k) + "mers" for k in ks]
+    extension = {"tsv": ".txt", "mtx": ".mtx", "npz": ".npz"}[out_format]
     print("\nParameters:\nfasta file = "+in_file)
-    print("k = "+str(k))
+    print("k = "+",".join([str(k) for k in ks]))
     print("prefix = "+str(prefix))
-    print("output file= "+str(out_file)+"\n")
+    if processes > 1:
+        print("processes = "+str(processes))
+    if approximate:
+        print("approximate: error = "+str(epsilon)+", sketch memory = "+str(memory)+" MB")
+        print("output file= "+", ".join([out_name + "_approx.txt" for out_name in out_names])+"\n")
+    else:
+        print("output file= "+", ".join([out_name + extension for out_name in out_names])+"\n")
 
     #--------------
     #The main event
     #--------------
-    seq = ""
     pc = 0
-    linecount = 0
-    knucs = {}
+    profiles = [new_profiles() for k in ks]
     
     print("Reading FASTA File...")
-    lines = IN.readlines()
-    for line in lines:
-        line=line.rstrip()
-        if re.search("^>",line):
-            if len(seq) > 0:
-                knucs  = process_it(knucs, seq, k, header)
-                seq = ""
-            ll = len(line)
-            header = line[1:ll] #remove the > from the front of the line
-            pc+=1
-            if pc % 100 == 0:
-                print("record count = "+str(pc))
-        else:
-            seq = seq + line.upper()
-        linecount+=1
-        if linecount % 10000 == 0:
-            print("line count = "+str(linecount))
-    knucs = process_it(knucs, seq, k, header)
+    batches = batch_records(read_fasta(IN), count=1000, bases=4 << 20)
+    work = sketch_batch if approximate else profile_batch
+    pool = None
+    if processes > 1:
+        pool = Pool(processes, initializer=init_profile, initargs=(ks,))
+        blocks = ordered_map(pool, work, batches, processes * 4)
+    else:
+        init_profile(ks)
+        blocks = map(work, batches)
+    if approximate:
+        sketch_counts(blocks, ks, out_names, prefix, epsilon, memory, queries)
+    else:
+        for block in blocks:
+            for k_profiles, k_block in zip(profiles, block):
+                add_block(k_profiles, k_block)
+            for i in range(pc // 100 + 1, (pc + len(block[0][0])) // 100 + 1):
+                print("record count = "+str(i * 100))
+            pc += len(block[0][0])
+    if pool is not None:
+        pool.close()
+        pool.join()
     
-    print("Sorting and Counting...")
-    kmers = {}
-    records = {}
-    for key, value in sorted(knucs.items()):
-        parts = re.split("\t", key)
-        record = parts[0]
-        kmer = parts[1]
-        if kmer in kmers:
-            kmers[kmer] = kmers[kmer] + 1
-        else:
-            kmers[kmer] = 1
-        if record in records:
-            records[record] = records[record] + 1
-        else:
-            records[record] = 1
+    if not approximate:
+        for k, out_name in zip(ks, out_names):
+            print("Sorting and Counting "+str(k)+"-mers...")
+            matrix = build_matrix(profiles[0], k)
+            del profiles[0]
 
-    print("Printing...")
-    OUT.write(str(k)+"-mer")
-    for i, value in sorted(records.items()):
-        OUT.write("\t"+str(prefix)+"_"+str(i))
-    OUT.write("\n")
-    for i, value in sorted(kmers.items()):
-        OUT.write(i)
-        for j, value2 in sorted(records.items()):
-            key = j + "\t" + i
-            if key in knucs:
-                OUT.write("\t"+str(knucs[key]))
+            print("Printing "+out_name+extension+"...")
+            if out_format == "tsv":
+                with open(out_name+extension, "w") as OUT:
+                    write_tsv(OUT, k, prefix, *matrix)
+            elif out_format == "mtx":
+                write_mtx(out_name, prefix, *matrix)
             else:
-                OUT.write("\t0")
-        OUT.write("\n")
-            
+                write_npz(out_name+extension, prefix, *matrix)
+
     IN.close()
-    OUT.close()
     
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -18,9 +18,156 @@
 ### Jennifer Meneghin                                                               ###
 ### Original Perl version: 02/04/2009                                               ###
 ### Python version: 01/21/2020                                                      ###
+###                                                                                 ###
+### Update:                                                                         ###
+### The file is read once. Each sequence is scanned a single time for runs of at    ###
+### least the minimum length and only the longest run of each base is kept. The     ###
+### matrix is worked out from those maxima, and runs on until the first length no   ###
+### entry reaches, as before. The PolyT column used to count poly-A runs for every  ###
+### entry but the last; it now counts poly-T runs.                                  ###
+###                                                                                 ###
+### Update:                                                                         ###
+### Sequences are handled in batches with NumPy: a batch is packed into one byte    ###
+### array, runs start wherever a byte differs from the one before it (or a record   ###
+### starts), and the longest run of each base per record is a scattered maximum    ###
+### over the runs. -r <file> writes the number of runs of every length for each     ###
+### base (all runs, not just the longest) as a tab delimited table.                 ###
+###                                                                                 ###
+### Update:                                                                         ###
+### The records are no longer all kept for the output fasta. With -s they are       ###
+### written as they are read, in input order. Otherwise (sorted by header, as       ###
+### before) they are kept until -b MB are used, then sorted and written to a        ###
+### temporary file (-T sets the directory), and the files are merged at the end.    ###
+### Each record's longest runs are kept as a packed array of six numbers.           ###
 #######################################################################################
 
-import re, sys, getopt
+import heapq, sys, getopt, tempfile
+from itertools import groupby
+import numpy as np
+from seq_reader import read_fasta, batch_records
+
+#Bases counted, in the order of the matrix columns, and the order
+#they are listed in the output fasta headers
+BASES = "ATGCNX"
+HEADER_ORDER = "ATGCXN"
+
+#Column of each byte value in BASES order, -1 for anything else
+COLUMN = np.full(256, -1, dtype=np.int64)
+COLUMN[np.frombuffer(BASES.encode(), dtype=np.uint8)] = np.arange(len(BASES))
+
+#Rough bytes of memory used to keep one record for sorting, on top of
+#its header and sequence
+RECORD_OVERHEAD = 200
+
+#--------------------------------------------------------------------
+#Find the runs in a batch of upper case sequences. Returns (maxima,
+#histograms): maxima[r][b] is the longest run of BASES[b] in sequence
+#r (0 when there is none), and histograms[b][n] is the number of runs
+#of BASES[b] that are n long.
+#--------------------------------------------------------------------
+def batch_runs(seqs):
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    starts = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=starts[1:])
+    codes = np.frombuffer("".join(seqs).encode("ascii", "replace"), dtype=np.uint8)
+    maxima = np.zeros((len(seqs), len(BASES)), dtype=np.int64)
+    histograms = [np.zeros(1, dtype=np.int64) for base in BASES]
+    if len(codes) == 0:
+        return maxima, histograms
+    filled = np.flatnonzero(lengths)
+    record_start = np.zeros(len(codes), dtype=bool)
+    record_start[starts[filled]] = True
+    run_start = np.empty(len(codes), dtype=bool)
+    run_start[0] = True
+    np.not_equal(codes[1:], codes[:-1], out=run_start[1:])
+    run_start |= record_start
+    run_starts = np.flatnonzero(run_start)
+    run_lengths = np.diff(np.append(run_starts, len(codes)))
+    run_columns = COLUMN[codes[run_starts]]
+    counted = run_columns >= 0
+    if not counted.any():
+        return maxima, histograms
+    run_columns = run_columns[counted]
+    run_lengths = run_lengths[counted]
+    run_records = filled[np.cumsum(record_start[run_starts])[counted] - 1]
+    np.maximum.at(maxima.reshape(-1), run_records * len(BASES) + run_columns, run_lengths)
+    width = int(run_lengths.max()) + 1
+    histograms = list(np.bincount(run_columns * width + run_lengths, minlength=len(BASES) * width).reshape(len(BASES), width))
+    return maxima, histograms
+
+#Add counts by length, growing the total as needed
+def add_counts(total, counts):
+    if len(counts) > len(total):
+        total, counts = counts.copy(), total
+    total[:len(counts)] += counts
+    return total
+
+#--------------------------------------------------------------------
+#Rows of the matrix: for each length from minimum up to the first
+#length no entry reaches, the number of entries with a run of at
+#least that length, for each base. histograms[b][m] is the number of
+#entries whose longest run of base b is m.
+#--------------------------------------------------------------------
+def matrix_rows(histograms, minimum):
+    longest = max([len(histogram) for histogram in histograms]) - 1
+    at_least = np.zeros((len(histograms), max(longest, minimum) + 2), dtype=np.int64)
+    for row, histogram in zip(at_least, histograms):
+        row[:len(histogram)] = np.cumsum(histogram[::-1])[::-1]
+    for i in range(minimum, max(longest, minimum - 1) + 2):
+        yield i, at_least[:, i].tolist()
+
+#------------------------------------------------------------
+#The annotation written after a header, e.g. "A=24, C=8", for
+#the bases whose longest run is at least minimum
+#------------------------------------------------------------
+def annotation(maxima, minimum):
+    runs = dict(zip(BASES, maxima))
+    return ", ".join([base + "=" + str(runs[base]) for base in HEADER_ORDER if runs[base] >= minimum])
+
+#Write one record to the output fasta, with its annotation if it has one
+def write_record(OUT, header, seq, maxima, minimum):
+    runs = annotation(maxima, minimum) if max(maxima) >= minimum else ""
+    if runs:
+        OUT.write(">"+header+" "+runs+"\n")
+    else:
+        OUT.write(">"+header+"\n")
+    OUT.write(seq+"\n")
+
+#-------------------------------------------------------------------
+#Write records sorted by (header, input position) to a temporary
+#file, three lines each: header, position and packed maxima in hex,
+#sequence. Returns the file, rewound.
+#-------------------------------------------------------------------
+def write_run(records, temp_dir):
+    RUN = tempfile.TemporaryFile(mode="w+", dir=temp_dir)
+    for header, position, packed, seq in sorted(records):
+        RUN.write(header+"\n"+str(position)+"\t"+packed.hex()+"\n"+seq+"\n")
+    RUN.seek(0)
+    return RUN
+
+#(header, position, packed maxima, sequence) for each record in a run
+def read_run(RUN):
+    for header in RUN:
+        position, packed = next(RUN).split("\t")
+        yield header[:-1], int(position), bytes.fromhex(packed), next(RUN)[:-1]
+
+#---------------------------------------------------------------------
+#Merge sorted lists of records (from read_run, or kept in memory) into
+#the output fasta, sorted by header. A header found more than once is
+#written once, with the last sequence and the longest runs of all of
+#them. Returns the number of records written.
+#---------------------------------------------------------------------
+def write_sorted(OUT, sources, minimum):
+    written = 0
+    merged = heapq.merge(*sources, key=lambda record: (record[0], record[1]))
+    for header, group in groupby(merged, key=lambda record: record[0]):
+        maxima = None
+        for header, position, packed, seq in group:
+            unpacked = np.frombuffer(packed, dtype=np.uint32)
+            maxima = unpacked if maxima is None else np.maximum(maxima, unpacked)
+        write_record(OUT, header, seq, maxima.tolist(), minimum)
+        written+=1
+    return written
 
 ############
 # Usage (-h)
@@ -36,7 +183,12 @@ def usage():
     usage = usage + "sequence length. The output is a tab delimmited matrix written to standard out.\n"
     usage = usage + "To write this output to a file, run as follows:\n"
     usage = usage + "homopolymer_count.pl -i fasta_file -m an_integer >my_file.txt\n\n"
-    usage = usage + "Usage: homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file>\n\n"
+    usage = usage + "With -r, the number of runs of every length for each base is also written to a\n"
+    usage = usage + "tab delimited file.\n\n"
+    usage = usage + "The output fasta is sorted by header, using temporary files when the records\n"
+    usage = usage + "need more than -b MB (256 by default). With -s the records are written in the\n"
+    usage = usage + "order they are read instead, without keeping them.\n\n"
+    usage = usage + "Usage: homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file> [-r <run length table>] [-s (input order) | -b <sort memory MB> -T <temp directory>]\n\n"
     usage = usage + "Jennifer Meneghin\n"
     usage = usage + "Original Perl version: 02/04/2009\n"
     usage = usage + "Python version: 01/24/2020\n"
@@ -53,16 +205,20 @@ def main(argv):
     in_file = ""
     minimum = 5
     out_file = "homopolymers.fasta"
+    runs_file = None
+    stream = False
+    memory = 256
+    temp_dir = None
     try:
-        opts, args = getopt.getopt(argv,"hi:o:m:",["ifile=","ofile=","mint="])
+        opts, args = getopt.getopt(argv,"hi:o:m:r:sb:T:",["ifile=","ofile=","mint=","runs=","stream","buffer=","tmpdir="])
     except getopt.GetoptError:
         print("\nNot a valid argument or value")
-        print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file>\n")
+        print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file> [-r <run length table>] [-s (input order) | -b <sort memory MB> -T <temp directory>]\n")
         sys.exit(2)
     for opt, arg in opts:
         if opt == "-h":
             print(usage())
-            print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file>\n")
+            print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file> [-r <run length table>] [-s (input order) | -b <sort memory MB> -T <temp directory>]\n")
             sys.exit()
         elif opt in ("-i", "--ifile"):
             in_file = arg
@@ -70,6 +226,23 @@ def main(argv):
             out_file = arg
         elif opt in ("-m", "--mint"):
             minimum = arg
+        elif opt in ("-r", "--runs"):
+            runs_file = arg
+        elif opt in ("-s", "--stream"):
+            stream = True
+        elif opt in ("-b", "--buffer"):
+            memory = arg
+        elif opt in ("-T", "--tmpdir"):
+            temp_dir = arg
+    try:
+        minimum = int(minimum)
+        memory = float(memory)
+    except ValueError:
+        minimum = 0
+    if minimum < 1 or memory <= 0:
+        print("\nNot a valid value: -m must be a whole number of 1 or more, and -b more than 0")
+        print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file> [-r <run length table>] [-s (input order) | -b <sort memory MB> -T <temp directory>]\n")
+        sys.exit(2)
 
     #----------------------------------
     #Open Files for reading and writing
@@ -78,212 +251,72 @@ def main(argv):
         IN = open(in_file,"r")
     except FileNotFoundError:
         print("\nFASTA Input File could not be found")
-        print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file>\n")
+        print("homopolymer_count.pl -i <fasta input file> -m N -o <fasta output file> [-r <run length table>] [-s (input order) | -b <sort memory MB> -T <temp directory>]\n")
         sys.exit(2)
     OUT = open(out_file,"w")
     print("\nParameters:\ninput file = "+in_file+"\noutput file = "+out_file+"\nMinimum Number to Count = "+str(minimum))
+    if runs_file is not None:
+        print("run length table = "+runs_file)
+    if stream:
+        print("output order = input")
 
     #-----------------------------------------
     #Read the Input FASTA and Print The Matrix
     #-----------------------------------------
-    headers = {}
-    records = {}
-    homopolymer_count = 9999
-    i = minimum
+    histograms = [np.zeros(1, dtype=np.int64) for base in BASES]
+    run_histograms = [np.zeros(1, dtype=np.int64) for base in BASES]
+    records = []
+    runs = []
+    used = 0
+    budget = int(memory * 1048576)
+    count = 0
+    total_seq_length = 0
+    entries = ((header.rstrip(), seq.upper()) for header, seq in read_fasta(IN))
+    for batch in batch_records(entries):
+        batch_maxima, batch_histograms = batch_runs([seq for header, seq in batch])
+        for column in range(len(BASES)):
+            histograms[column] = add_counts(histograms[column], np.bincount(batch_maxima[:, column]))
+            run_histograms[column] = add_counts(run_histograms[column], batch_histograms[column])
+        if stream:
+            for (header, seq), maxima in zip(batch, batch_maxima.tolist()):
+                write_record(OUT, header, seq, maxima, minimum)
+                count+=1
+                total_seq_length = total_seq_length + len(seq)
+            continue
+        for (header, seq), maxima in zip(batch, batch_maxima.astype(np.uint32)):
+            records.append((header, count, maxima.tobytes(), seq))
+            count+=1
+            total_seq_length = total_seq_length + len(seq)
+            used += len(header) + len(seq) + RECORD_OVERHEAD
+            if used >= budget:
+                runs.append(write_run(records, temp_dir))
+                records = []
+                used = 0
     print("Poly Seq Length\tPolyA\tPolyT\tPolyG\tPolyC\tPolyN\tPolyX")
-    lines = IN.readlines()
-    while homopolymer_count > 0:
-        total_seq_length = 0
-        count = 0
-        counta = 0
-        countt = 0
-        countg = 0
-        countc = 0
-        countx = 0
-        countn = 0
-        seq = ""
-        header = ""
-        for line in lines:
-            if re.search("^>",line):
-                if len(header)>0:
-                    count+=1
-                    records[header] = seq
-                    seqa = "A{"+str(i)+"}"              
-                    seqt = "T{"+str(i)+"}"              
-                    seqg = "G{"+str(i)+"}"
-                    seqc = "C{"+str(i)+"}"
-                    seqx = "X{"+str(i)+"}"
-                    seqn = "N{"+str(i)+"}"
-                    if re.search(seqa, seq):
-                        counta+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tA=" + str(i)
-                        else:
-                            headers[header] = "A=" + str(i)
-                    if re.search(seqa, seq):
-                        countt+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tT=" + str(i)
-                        else:
-                            headers[header] = "T=" + str(i)
-                    if re.search(seqg, seq):
-                        countg+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tG=" + str(i)
-                        else:
-                            headers[header] = "G=" + str(i)
-                    if re.search(seqc, seq):
-                        countc+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tC=" + str(i)
-                        else:
-                            headers[header] = "C=" + str(i)
-                    if re.search(seqx, seq):
-                        countx+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tX=" + str(i)
-                        else:
-                            headers[header] = "X=" + str(i)
-                    if re.search(seqn, seq):
-                        countn+=1
-                        if header in headers:
-                            headers[header] = headers[header] + "\tN=" + str(i)
-                        else:
-                            headers[header] = "N=" + str(i)
-                    homopolymer_count = counta + countt + countg + countc + countx + countn
-                    total_seq_length = total_seq_length + len(seq)
-                #ENDIF
-                header = line
-                header = header.rstrip()
-                len_header = len(header)
-                header = header[1:len_header] #removing  the ">" from the front of the header line
-                seq = ""
-            else:
-                seq = seq + line
-                seq = seq.rstrip()
-                seq = seq.upper()
-        #ENDFOR
-        count+=1
-        records[header] = seq
-        seqa = "A{"+str(i)+"}"
-        seqt = "T{"+str(i)+"}"
-        seqg = "G{"+str(i)+"}"
-        seqc = "C{"+str(i)+"}"
-        seqx = "X{"+str(i)+"}"
-        seqn = "N{"+str(i)+"}"
-        if re.search(seqa, seq):
-            counta+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tA=" + str(i)
-            else:
-                headers[header] = "A=" + str(i)
-        if re.search(seqt, seq):
-            countt+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tT=" + str(i)
-            else:
-                headers[header] = "T=" + str(i)
-        if re.search(seqg, seq):
-            countg+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tG=" + str(i)
-            else:
-                headers[header] = "G=" + str(i)
-        if re.search(seqc, seq):
-            countc+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tC=" + str(i)
-            else:
-                headers[header] = "C=" + str(i)
-        if re.search(seqx, seq):
-            countx+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tX=" + str(i)
-            else:
-                headers[header] = "X=" + str(i)
-        if re.search(seqn, seq):
-            countn+=1
-            if header in headers:
-                headers[header] = headers[header] + "\tN=" + str(i)
-            else:
-                headers[header] = "N=" + str(i)
-        homopolymer_count = counta + countt + countg + countc + countx + countn
-        total_seq_length = total_seq_length + len(seq)
-        average_seq_length = total_seq_length / count
-        total_seq_length = 0
-        print(str(i)+"\t"+str(counta)+"\t"+str(countt)+"\t"+str(countg)+"\t"+str(countc)+"\t"+str(countn)+"\t"+str(countx)) #runs once per homopolymer length
-        i=int(i)+1
-    #ENDWHILE
+    for i, counts in matrix_rows(histograms, minimum):
+        print(str(i)+"\t"+"\t".join([str(j) for j in counts])) #runs once per homopolymer length
     print("Number of Fasta Entries = " +str (count))
-    print("Average Sequence Length = " +str (average_seq_length))
+    print("Average Sequence Length = " +str (total_seq_length / count if count else 0))
+
+    if runs_file is not None:
+        with open(runs_file, "w") as RUNS:
+            RUNS.write("Run Length\t"+"\t".join(["Poly"+base for base in BASES])+"\n")
+            longest = max([len(histogram) for histogram in run_histograms])
+            table = np.zeros((longest, len(BASES)), dtype=np.int64)
+            for column, histogram in enumerate(run_histograms):
+                table[:len(histogram), column] = histogram
+            for length in range(1, longest):
+                RUNS.write(str(length)+"\t"+"\t".join([str(i) for i in table[length].tolist()])+"\n")
 
     #-------------------------------------
     #Write the Results to the Output FASTA
     #-------------------------------------
-    #for key, value in sorted(headers.items()):
-    for key, value in sorted(records.items()):
-        key = key.rstrip()
-        if key in headers:
-            if re.search("\t",headers[key]):
-                acount = 0
-                tcount = 0
-                gcount = 0
-                ccount = 0
-                xcount = 0
-                ncount = 0
-                polycounts = re.split("\t", headers[key])
-                for j in polycounts:
-                    parts = re.split("=", j)
-                    if (parts[0] == "A") and (int(parts[1]) > int(acount)):
-                        acount = parts[1]
-                    elif (parts[0] == "T") and (int(parts[1]) > int(tcount)):
-                        tcount = parts[1]
-                    elif (parts[0] == "G") and (int(parts[1]) > int(gcount)):
-                        gcount = parts[1]
-                    elif (parts[0] == "C") and (int(parts[1]) > int(ccount)):
-                        ccount = parts[1]
-                    elif (parts[0] == "X") and (int(parts[1]) > int(xcount)):
-                        xcount = parts[1]
-                    elif (parts[0] == "N") and (int(parts[1]) > int(ncount)):
-                        ncount = parts[1]
-                    else:
-                        print("ERROR!")
-                        print(usage())
-                        sys.exit(2)
-                OUT.write(">"+str(key)+" ")
-                if int(acount) > 0:
-                    OUT.write("A="+str(acount))
-                    if (int(tcount) > 0 or int(gcount) > 0 or int(ccount) > 0 or int(xcount) > 0 or int(ncount) > 0):
-                        OUT.write(", ")
-                if int(tcount) > 0:
-                    OUT.write("T="+str(tcount))
-                    if (int(gcount) > 0 or int(ccount) > 0 or int(xcount) > 0 or int(ncount) > 0):
-                        OUT.write(", ")
-                if int(gcount) > 0:
-                    OUT.write("G="+str(gcount))
-                    if (int(ccount) > 0 or int(xcount) > 0 or int(ncount) > 0):
-                        OUT.write(", ")
-                if int(ccount) > 0:
-                    OUT.write("C="+str(ccount))
-                    if (int(xcount) > 0 or int(ncount) > 0):
-                        OUT.write(", ")
-                if int(xcount) > 0:
-                    OUT.write("X="+str(xcount))
-                    if int(ncount) > 0:
-                        OUT.write(", ")
-                if int(ncount) > 0:
-                    OUT.write("N="+str(ncount))
-                OUT.write("\n")
-                OUT.write(records[key]+"\n")
-            else:
-                OUT.write(">"+str(key)+" "+str(headers[key])+"\n")
-                OUT.write(value+"\n")
-            #ENDIF
-        else:
-            OUT.write(">"+str(key)+"\n")
-            OUT.write(value+"\n")
-            #ENDIF
-    #ENDFOR
+    if not stream:
+        records.sort()
+        write_sorted(OUT, [read_run(RUN) for RUN in runs] + [iter(records)], minimum)
+        for RUN in runs:
+            RUN.close()
+
     #-----------
     #Close Files
     #-----------
@@ -292,4 +325,3 @@ def main(argv):
 
 if __name__ == "__main__":
     main(sys.argv[1:])
-
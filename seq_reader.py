@@ -0,0 +1,266 @@
+#####################################################################################
+### Sequence Reader                                                               ###
+### Shared streaming readers used by the FASTA scripts in this directory.         ###
+###                                                                               ###
+### read_fasta(IN) yields one (header, sequence) tuple per fasta entry:           ###
+### header   = every thing between > and the end of the line                      ###
+### sequence = the sequence lines joined together, with end of line white space   ###
+###            removed (case is left alone)                                       ###
+###                                                                               ###
+### The file is read in fixed size chunks and each sequence is assembled with a   ###
+### single join, so memory use is bounded by the largest single record instead of ###
+### the whole file. IN can be opened in text ("r") or binary ("rb") mode; the     ###
+### records come back as str or bytes to match.                                   ###
+###                                                                               ###
+### read_fastq(IN) does the same for fastq files, yielding one                    ###
+### (header, sequence, quality) tuple per entry.                                  ###
+###                                                                               ###
+### fasta_index(in_file) gives samtools style .fai offsets for a fasta file, read  ###
+### from <in_file>.fai, or built once and saved there, and fetch_sequence reads   ###
+### one sequence from the file by random access.                                  ###
+#####################################################################################
+
+import os
+from collections import deque
+
+CHUNK_SIZE = 1 << 20
+
+#------------------------------------------------------------
+#Split a file into lines, reading CHUNK_SIZE characters at a
+#time. A line longer than a chunk (e.g. an unwrapped
+#chromosome) is collected in pieces and joined once.
+#------------------------------------------------------------
+def read_lines(IN, chunk_size=CHUNK_SIZE):
+    pending = []
+    empty = newline = None
+    while True:
+        chunk = IN.read(chunk_size)
+        if not chunk:
+            break
+        if empty is None:
+            empty = chunk[:0]
+            newline = b"\n" if isinstance(chunk, bytes) else "\n"
+        lines = chunk.split(newline)
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+        if pending:
+            pending.append(lines[0])
+            lines[0] = empty.join(pending)
+        pending = [lines.pop()]
+        yield from lines
+    if pending:
+        last = empty.join(pending)
+        if last:
+            yield last
+
+#--------------------------------------
+#Yield (header, sequence) for each entry
+#--------------------------------------
+def read_fasta(IN, chunk_size=CHUNK_SIZE):
+    header = None
+    parts = []
+    empty = marker = carriage = None
+    for line in read_lines(IN, chunk_size):
+        if empty is None:
+            empty = line[:0]
+            marker, carriage = (b">", b"\r") if isinstance(line, bytes) else (">", "\r")
+        if line[:1] == marker:
+            if header is not None:
+                yield header, empty.join(parts)
+            header = line[1:].rstrip(carriage)
+            parts = []
+        elif header is not None:
+            parts.append(line.rstrip())
+    if header is not None:
+        yield header, empty.join(parts)
+
+#----------------------------------------------------------------
+#Yield (header, sequence, quality) for each fastq entry. Entries
+#are the usual four lines: @header, sequence, +, quality.
+#----------------------------------------------------------------
+def read_fastq(IN, chunk_size=CHUNK_SIZE):
+    lines = read_lines(IN, chunk_size)
+    for header in lines:
+        header = header.rstrip()
+        if not header:
+            continue
+        seq = next(lines, None)
+        plus = next(lines, None)
+        qual = next(lines, None)
+        if header[:1] not in ("@", b"@") or plus is None or plus[:1] not in ("+", b"+") or qual is None:
+            raise ValueError("Not a valid fastq entry: " + repr(header))
+        seq = seq.rstrip()
+        qual = qual.rstrip()
+        if len(qual) != len(seq):
+            raise ValueError("Sequence and quality lengths differ: " + repr(header))
+        yield header[1:], seq, qual
+
+#------------------------------------------------------------
+#Split a fasta file into about "count" byte ranges that each
+#start at a record boundary (a > at the start of a line), so
+#each range can be read on its own with FileRange. Returns a
+#list of (start, end) offsets covering the whole file in order.
+#------------------------------------------------------------
+def record_ranges(in_file, count, chunk_size=CHUNK_SIZE):
+    IN = open(in_file, "rb")
+    size = IN.seek(0, 2)
+    offsets = [0]
+    for i in range(1, count):
+        position = max(size * i // count, offsets[-1] + 1) - 1
+        found = -1
+        while position < size - 1:
+            IN.seek(position)
+            block = IN.read(chunk_size)
+            found = block.find(b"\n>")
+            if found != -1:
+                found = position + found + 1
+                break
+            position += len(block) - 1
+        if found == -1:
+            break
+        offsets.append(found)
+    IN.close()
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+#--------------------------------------------------------
+#A binary file handle that only reads from start to end.
+#read_fasta(FileRange(in_file, start, end)) gives the
+#records of one range from record_ranges.
+#--------------------------------------------------------
+class FileRange:
+    def __init__(self, in_file, start, end):
+        self.IN = open(in_file, "rb")
+        self.IN.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.IN.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.IN.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#---------------------------------------------------------------
+#Group records into lists of up to "count" records or about
+#"bases" bases, whichever comes first, for handing to worker
+#processes. size(record) gives the bases in one record (by
+#default the length of its sequence, record[1]).
+#---------------------------------------------------------------
+def batch_records(records, count=10000, bases=16 << 20, size=None):
+    if size is None:
+        size = lambda record: len(record[1])
+    batch = []
+    total = 0
+    for record in records:
+        batch.append(record)
+        total += size(record)
+        if len(batch) >= count or total >= bases:
+            yield batch
+            batch = []
+            total = 0
+    if batch:
+        yield batch
+
+#-----------------------------------------------------------------
+#Like pool.imap(function, items), but never more than "window"
+#items are read ahead of the results, so a fast reader can't fill
+#memory while the workers catch up. Results come back in order.
+#-----------------------------------------------------------------
+def ordered_map(pool, function, items, window):
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+#--------------------------------------------------------------------
+#Index a fasta file the way samtools faidx does: for each sequence
+#name (the header up to the first white space) keep its length, the
+#offset of its first base, and the bases and bytes per line. Every
+#line of a sequence but the last must be the same length, and the
+#last line no longer.
+#--------------------------------------------------------------------
+def build_index(in_file):
+    index = {}
+    with open(in_file, "rb") as IN:
+        offset = 0
+        name = None
+        for line in IN:
+            offset += len(line)
+            if line[:1] == b">":
+                if name is not None:
+                    index[name] = entry
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+                if name in index:
+                    raise ValueError("Duplicate sequence name in "+in_file+": "+name)
+                entry = [0, offset, 0, 0]
+                short = False
+                continue
+            if name is None:
+                continue
+            bases = len(line.rstrip(b"\r\n"))
+            if (short and bases) or (entry[0] and bases > entry[2]):
+                raise ValueError("Sequence lines are not all the same length in "+in_file+": "+name)
+            if entry[0] == 0:
+                if bases == 0:
+                    entry[1] = offset
+                    continue
+                entry[2] = bases
+                entry[3] = len(line)
+            elif bases != entry[2] or len(line) != entry[3]:
+                short = True
+            entry[0] += bases
+        if name is not None:
+            index[name] = entry
+    return dict([(name, tuple(entry)) for name, entry in index.items()])
+
+#------------------------------------------------------------------
+#The index of a fasta file, from <in_file>.fai when it is at least
+#as new as the fasta file, otherwise built and saved there (when
+#the directory can be written to). Returns {name: (length, offset,
+#bases per line, bytes per line)}.
+#------------------------------------------------------------------
+def fasta_index(in_file):
+    index_file = in_file + ".fai"
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(in_file):
+        index = {}
+        with open(index_file) as INDEX:
+            for line in INDEX:
+                fields = line.rstrip("\n").split("\t")
+                index[fields[0]] = tuple([int(i) for i in fields[1:5]])
+        return index
+    index = build_index(in_file)
+    try:
+        with open(index_file, "w") as INDEX:
+            for name, entry in index.items():
+                INDEX.write(name + "\t" + "\t".join([str(i) for i in entry]) + "\n")
+    except OSError:
+        pass
+    return index
+
+#----------------------------------------------------------------
+#Read one indexed sequence from a fasta file opened in binary mode
+#----------------------------------------------------------------
+def fetch_sequence(IN, entry):
+    length, offset, line_bases, line_bytes = entry
+    if length == 0:
+        return b""
+    lines, extra = divmod(length, line_bases)
+    IN.seek(offset)
+    data = IN.read(lines * line_bytes + extra)
+    if line_bytes == line_bases:
+        return data
+    return data.replace(b"\r", b"").replace(b"\n", b"")
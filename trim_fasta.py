@@ -5,16 +5,29 @@
 ### Python Version: 01/25/2020        ###
 #########################################
 
-import re, sys, getopt
+import json, re, resource, sys, time, getopt
+from collections import Counter
+from itertools import zip_longest
+from multiprocessing import Pool
+import numpy as np
+from seq_reader import read_fasta, read_fastq, batch_records, ordered_map
 
 def usage ():
-    usage = "Usage: trim_fasta.pl -i fasta_file -m integer -p integer -c 1\n\n"
+    usage = "Usage: trim_fasta.pl -i fasta_file -m integer -p integer -c 1 -n integer\n"
+    usage = usage + "       trim_fasta.pl -i R1_fastq_file -r R2_fastq_file -m integer -p integer -c 1 -q integer -w integer -n integer\n\n"
     usage = usage + "Parameters:\n"
-    usage = usage + "-i fasta_file:\tThe fasta file to trim.\n"
+    usage = usage + "-i fasta_file:\tThe fasta (or fastq) file to trim.\n"
+    usage = usage + "-r fastq_file:\tThe R2 fastq file, for paired end reads. (Optional.)\n"
     usage = usage + "-m integer:\tThe minimum length allowed for a fasta record. (Optional. Default is 50.)\n"
     usage = usage + "-p integer:\tThe minimum length of a Poly(A/T) sequence to consider. (Optional. Default is 8.)\n"
     usage = usage + "-c 1\t\t1 = Remove sequences with Poly(A/T) in the middle of the sequence, 0 = Don't remove.\n"
-    usage = usage + "\t\t(Optional. Default is 0 = Don't remove.)\n\n"
+    usage = usage + "\t\t(Optional. Default is 0 = Don't remove.)\n"
+    usage = usage + "-q integer:\tFastq only: cut each read at the first window with an average quality below this. (Optional. Default is 0 = Don't cut.)\n"
+    usage = usage + "-w integer:\tThe quality window size for -q. (Optional. Default is 4.)\n"
+    usage = usage + "-n integer:\tThe number of worker processes to trim with. (Optional. Default is 1.)\n"
+    usage = usage + "-l log_file:\tWrite a line for every removed sequence to this file. (Optional.)\n"
+    usage = usage + "-j json_file:\tWrite a run report (counts, sequence lengths before and after trimming,\n"
+    usage = usage + "\t\twall time, records/sec and peak memory) to this file. (Optional.)\n\n"
     usage = usage + "This script trims any Poly(A/T) tails from the beginning and end of each sequence,\n"
     usage = usage + "then removes the sequence if it's length is less than the minimum number provided (-m integer).\n"
     usage = usage + "If -c is set to 1, it also removes any sequences with a Poly(A/T) sequence in the middle of the sequence (assumed to be chimera).\n\n"
@@ -23,42 +36,241 @@ def usage ():
     usage = usage + "A Poly(T) sequence is defined as (-p integer) or more consecutive Ts, Xs or Ns.\n"
     usage = usage + "Please run homopolymer_count.pl to help you decide the most appropriate length of Poly(A/T) sequence for your dataset.\n\n"
     usage = usage + "It returns two new fasta files: one with the removed sequences (fasta_file.removed), and one with the salvaged sequences (fasta_file.salvaged).\n\n"
+    usage = usage + "Fastq input (detected from the @ at the start of the file) is trimmed the same way and written as fastq.\n"
+    usage = usage + "With -q, reads are first cut at the start of the first -w base window whose average (Phred+33) quality is below -q.\n"
+    usage = usage + "Reads shortened by -q are also removed if they end up shorter than -m.\n"
+    usage = usage + "With -r, R1 and R2 are read together and kept in sync: if either mate is removed, both go to the .removed files.\n"
+    usage = usage + "The counts are then counts of pairs.\n\n"
     usage = usage + "Jennifer Meneghin\n"
     usage = usage + "01/27/2020\n"
     return usage
 
-def trim_it(header, string, stringa, stringt):
-    if re.search("^"+stringa, string):
-        length = len(string)
-        count = 0
-        for i in string:
-            if not(i == "A") and not(i == "N") and not(i == "X"):
-                string = string[count:length]
-                break
-            count+=1
-    if re.search("^"+stringt, string):
-        length = len(string)
-        count = 0
-        for i in string:
-            if not(i == "T") and not(i == "N") and not(i == "X"):
-                string = string[count:length]
-                break
-            count+=1
-    if re.search(stringa+"$",string):
-        length = len(string)
-        while length > 0:
-            if not(string[length-1] == "A") and not(string[length-1] == "N") and not(string[length-1] == "X"):
-                string = string[0:length]
-                break
-            length=length-1
-    if re.search(stringt+"$",string):
-        length = len(string)
-        while length > 0:
-            if not(string[length-1] == "T") and not(string[length-1] == "N") and not(string[length-1] == "X"):
-                string = string[0:length]
-                break
-            length=length-1
-    return string
+POLY_A = "AXN"
+POLY_T = "TXN"
+PHRED_OFFSET = 33
+
+#-----------------------------------------------------------------
+#Compile the Poly(A/T) search once: poly_length or more consecutive
+#As, Xs or Ns, or Ts, Xs or Ns, anywhere in the sequence
+#-----------------------------------------------------------------
+def compile_poly(poly_length):
+    return re.compile("[AXN]{%d}|[TXN]{%d}" % (poly_length, poly_length)).search
+
+#------------------------------------------------------------------
+#Trim Poly(A) then Poly(T) runs from the start, then Poly(A) then
+#Poly(T) runs from the end. Each run is measured with one lstrip or
+#rstrip scan. A sequence made up entirely of the run is left alone.
+#Returns the (start, end) of the trimmed sequence, so the quality
+#string of a fastq entry can be cut to match.
+#------------------------------------------------------------------
+def trim_span(string, poly_length):
+    start = 0
+    end = len(string)
+    for letters in (POLY_A, POLY_T):
+        rest = string[start:end]
+        run = len(rest) - len(rest.lstrip(letters))
+        if run >= poly_length and run < len(rest):
+            start += run
+    for letters in (POLY_A, POLY_T):
+        rest = string[start:end]
+        run = len(rest) - len(rest.rstrip(letters))
+        if run >= poly_length and run < len(rest):
+            end -= run
+    return start, end
+
+def trim_it(string, poly_length):
+    start, end = trim_span(string, poly_length)
+    return string[start:end]
+
+#-------------------------------------------------------------------
+#Trim one sequence and classify it. Returns (start, end, found,
+#internal): the trimmed sequence is string[start:end], found is True
+#if the original sequence had a Poly(A/T) run anywhere, and internal
+#is True if the trimmed sequence still has one (a chimera).
+#poly_search is only run once per sequence: a trimmed sequence had a
+#run at one of its ends, and an untrimmed one is unchanged, so its
+#first search answers both.
+#-------------------------------------------------------------------
+def trim_record(string, poly_length, poly_search):
+    start, end = trim_span(string, poly_length)
+    if end - start < len(string):
+        return start, end, True, poly_search(string[start:end]) is not None
+    found = poly_search(string) is not None
+    return start, end, found, found
+
+#---------------------------------------------------------------------
+#Sliding window quality trimming for a whole batch of quality strings
+#at once. Every read is cut at the start of the first window whose
+#average quality is below minimum_quality. All qualities are joined
+#into one array and the window sums come from one cumulative sum, so
+#no Python loop runs over the bases. Returns the length to keep for
+#each read (reads shorter than the window are kept whole).
+#---------------------------------------------------------------------
+def quality_cuts(quals, window, minimum_quality):
+    lengths = np.array([len(qual) for qual in quals], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    total = int(ends[-1]) if len(ends) else 0
+    scores = np.frombuffer("".join(quals).encode("ascii"), dtype=np.uint8).astype(np.int64) - PHRED_OFFSET
+    sums = np.zeros(total + 1, dtype=np.int64)
+    np.cumsum(scores, out=sums[1:])
+    positions = np.arange(total, dtype=np.int64)
+    read_ends = np.repeat(ends, lengths)
+    full = positions + window <= read_ends
+    window_sums = sums[np.minimum(positions + window, total)] - sums[positions]
+    failed = full & (window_sums < minimum_quality * window)
+    first = np.append(np.where(failed, positions, total), total)
+    first = np.minimum.reduceat(first, np.minimum(starts, total))
+    keep = np.where((lengths > 0) & (first < ends), first - starts, lengths)
+    return keep.tolist()
+
+COUNTERS = ["removed", "too_short", "chimera", "salvaged", "trimmed", "total"]
+SETTINGS = {}
+
+#--------------------------------------------------------------
+#Settings used by trim_batch (set once in every worker process)
+#--------------------------------------------------------------
+def init_trim(poly_length, minimum_sequence_length, remove_chimera_flag, minimum_quality=0, window=4, detail=False):
+    SETTINGS["poly_length"] = poly_length
+    SETTINGS["poly_search"] = compile_poly(poly_length)
+    SETTINGS["minimum_sequence_length"] = minimum_sequence_length
+    SETTINGS["remove_chimera_flag"] = remove_chimera_flag
+    SETTINGS["minimum_quality"] = minimum_quality
+    SETTINGS["window"] = window
+    SETTINGS["detail"] = detail
+
+#--------------------------------------------------------
+#Write one entry as fasta (no quality) or as fastq text
+#--------------------------------------------------------
+def format_entry(header, string, qual):
+    if qual is None:
+        return ">" + header + "\n" + string + "\n"
+    return "@" + header + "\n" + string + "\n+\n" + qual + "\n"
+
+#----------------------------------------------------------------------
+#Trim and classify a batch of records. Each record is a tuple of mates
+#(one for fasta or single end fastq, two for paired fastq) and each mate
+#is (header, sequence, quality or None). If either mate of a pair is
+#removed, the whole pair is removed. Returns the salvaged and removed
+#text for each mate, the detail log messages (only if asked for), the
+#counters, and Counters of sequence lengths before and after trimming
+#for the batch, all in input order.
+#----------------------------------------------------------------------
+def trim_batch(batch):
+    poly_length = SETTINGS["poly_length"]
+    poly_search = SETTINGS["poly_search"]
+    minimum_sequence_length = SETTINGS["minimum_sequence_length"]
+    remove_chimera_flag = SETTINGS["remove_chimera_flag"]
+    mates = len(batch[0])
+    counts = dict.fromkeys(COUNTERS, 0)
+    salvaged = [[] for i in range(mates)]
+    removed = [[] for i in range(mates)]
+    messages = []
+    detail = SETTINGS["detail"]
+    before = Counter()
+    after = Counter()
+    cuts = [None] * mates
+    if SETTINGS["minimum_quality"] > 0 and batch[0][0][2] is not None:
+        for m in range(mates):
+            cuts[m] = quality_cuts([record[m][2] for record in batch], SETTINGS["window"], SETTINGS["minimum_quality"])
+    for i, record in enumerate(batch):
+        counts["total"]+=1
+        entries = []
+        trimmed = False
+        too_short = False
+        chimera = False
+        for m, (header, string, qual) in enumerate(record):
+            before[len(string)]+=1
+            quality_trimmed = cuts[m] is not None and cuts[m][i] < len(string)
+            if quality_trimmed:
+                string = string[:cuts[m][i]]
+                qual = qual[:cuts[m][i]]
+            start, end, found, internal = trim_record(string, poly_length, poly_search)
+            if end - start < len(string):
+                string = string[start:end]
+                if qual is not None:
+                    qual = qual[start:end]
+                quality_trimmed = True
+            trimmed = trimmed or quality_trimmed
+            if found or quality_trimmed:
+                if len(string) < minimum_sequence_length:
+                    too_short = True
+                elif internal:
+                    chimera = True
+            after[len(string)]+=1
+            entries.append(format_entry(header, string, qual))
+        header = entries[0][:entries[0].index("\n")+1]
+        if trimmed:
+            counts["trimmed"]+=1
+        if too_short:
+            output = removed
+            if detail:
+                messages.append("Removed too short: "+str(header))
+            counts["removed"]+=1
+            counts["too_short"]+=1
+        elif chimera:
+            counts["chimera"]+=1
+            if remove_chimera_flag == 1:
+                output = removed
+                if detail:
+                    messages.append("Removed as chimera (Poly(A/T) in middle): "+str(header))
+                counts["removed"]+=1
+            else:
+                output = salvaged
+                counts["salvaged"]+=1
+        else:
+            output = salvaged
+            counts["salvaged"]+=1
+        for m in range(mates):
+            output[m].append(entries[m])
+    return ["".join(i) for i in salvaged], ["".join(i) for i in removed], messages, counts, before, after
+
+#------------------------------------------------------------------
+#Summarize a Counter of sequence lengths for the run report: count,
+#min, max, mean, median and the [length, count] pairs themselves
+#------------------------------------------------------------------
+def length_summary(lengths):
+    count = sum(lengths.values())
+    summary = {"count": count, "min": 0, "max": 0, "mean": 0, "median": 0, "histogram": []}
+    if count == 0:
+        return summary
+    histogram = sorted(lengths.items())
+    summary["min"] = histogram[0][0]
+    summary["max"] = histogram[-1][0]
+    summary["mean"] = sum(length * n for length, n in histogram) / count
+    seen = 0
+    for length, n in histogram:
+        seen += n
+        if seen * 2 >= count:
+            summary["median"] = length
+            break
+    summary["histogram"] = [[length, n] for length, n in histogram]
+    return summary
+
+#------------------------------------------------------------
+#The id of a read's pair: the header up to the first white
+#space, without a trailing /1 or /2
+#------------------------------------------------------------
+def mate_id(header):
+    name = header.split(None, 1)[0] if header.strip() else ""
+    if name[-2:] in ("/1", "/2"):
+        name = name[:-2]
+    return name
+
+#------------------------------------------------------------
+#Read R1 and R2 fastq files together, one pair at a time, and
+#check that the two reads of each pair have the same id
+#------------------------------------------------------------
+def read_pairs(IN, MATE):
+    for first, second in zip_longest(read_fastq(IN), read_fastq(MATE)):
+        if first is None or second is None:
+            raise ValueError("The R1 and R2 fastq files have different numbers of entries")
+        if mate_id(first[0]) != mate_id(second[0]):
+            raise ValueError("The R1 and R2 fastq files are out of sync: "+first[0].rstrip()+" is paired with "+second[0].rstrip())
+        yield first, second
+
+def record_size(record):
+    return sum(len(mate[1]) for mate in record)
 
 def main(argv):
 
@@ -68,33 +280,62 @@ def main(argv):
     in_file = ""
     minimum_sequence_length = 50
     poly_length = 8
+    mate_file = ""
+    log_file = ""
+    report_file = ""
     remove_chimera_flag = 0
+    minimum_quality = 0
+    window = 4
+    processes = 1
     try:
-        opts, args = getopt.getopt(argv,"hi:m:p:c:",["ifile=","mint=","pint=","cint="])
+        opts, args = getopt.getopt(argv,"hi:r:m:p:c:q:w:n:l:j:",["ifile=","rfile=","mint=","pint=","cint=","qint=","wint=","processes=","lfile=","jfile="])
     except getopt.GetoptError:
         print("\nNot a valid argument or value")
-        print("trim_fasta.pl -i <fasta input file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no>\n")
+        print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
         sys.exit(2)
     for opt, arg in opts:
         if opt == "-h":
             print(usage())
-            print("trim_fasta.pl -i <fasta input file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no>\n")
+            print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
             sys.exit()
         elif opt in ("-i", "--ifile"):
             in_file = arg
+        elif opt in ("-r", "--rfile"):
+            mate_file = arg
         elif opt in ("-m", "--mint"):
             minimum_sequence_length = arg
         elif opt in ("-p", "--pint"):
             poly_length = arg
         elif opt in ("-c", "--cint"):
             remove_chimera_flag = arg
+        elif opt in ("-q", "--qint"):
+            minimum_quality = arg
+        elif opt in ("-w", "--wint"):
+            window = arg
+        elif opt in ("-n", "--processes"):
+            processes = arg
+        elif opt in ("-l", "--lfile"):
+            log_file = arg
+        elif opt in ("-j", "--jfile"):
+            report_file = arg
 
     remove_chimera_flag = int(remove_chimera_flag)
+    minimum_quality = int(minimum_quality)
+    window = int(window)
+    if window < 1:
+        print("\nNot a valid quality window size: -w must be 1 or more. You entered: "+str(window))
+        print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
+        sys.exit(2)
+    processes = int(processes)
+    if processes < 1:
+        print("\nNot a valid number of processes: -n must be 1 or more. You entered: "+str(processes))
+        print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
+        sys.exit(2)
     if not remove_chimera_flag == 0:
         if not remove_chimera_flag == 1:
             #print("bad flag")
             print("\nNot a valid chimera flag: -c must be 1 or 0. You entered: "+str(remove_chimera_flag))
-            print("trim_fasta.pl -i <fasta input file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no>\n")
+            print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
             sys.exit(2)
         
     #----------------------------------
@@ -102,114 +343,103 @@ def main(argv):
     #----------------------------------
     try:
         IN = open(in_file,"r")
+        fastq = IN.read(1) == "@"
+        IN.seek(0)
+        MATE = None
+        if mate_file:
+            MATE = open(mate_file,"r")
     except FileNotFoundError:
         print("\nFASTA Input File could not be found")
-        print("trim_fasta.pl -i <fasta input file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no>\n")
+        print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
+        sys.exit(2)
+    if MATE is not None and not fastq:
+        print("\nPaired end input (-r) must be in fastq format")
+        print("trim_fasta.pl -i <fasta or fastq input file> -r <R2 fastq file> -m <minimum sequence length -p <minimum polyt(A/T) sequence length> -c <chimera flag 1=yes or 0=no> -q <minimum average quality> -w <quality window size> -n <number of processes> -l <detail log file> -j <json report file>\n")
         sys.exit(2)
 
-    salvaged_file = in_file + ".salvaged"
-    removed_file = in_file + ".removed"
-    SALVAGED = open(salvaged_file,"w")
-    REMOVED = open(removed_file,"w")
+    LOG = None
+    if log_file:
+        LOG = open(log_file,"w",buffering=1<<20)
+    SALVAGED = [open(in_file + ".salvaged","w")]
+    REMOVED = [open(in_file + ".removed","w")]
+    if MATE is not None:
+        SALVAGED.append(open(mate_file + ".salvaged","w"))
+        REMOVED.append(open(mate_file + ".removed","w"))
     print("\nParameters:\nfasta file = "+in_file)
+    if MATE is not None:
+        print("R2 fastq file = "+mate_file)
     print("minimum sequence length = "+str(minimum_sequence_length))
     print("minimum Poly(A/T) length = "+str(poly_length))
-    print("remove chimera flag = "+str(remove_chimera_flag)+"\n")
+    print("remove chimera flag = "+str(remove_chimera_flag))
+    if fastq:
+        print("minimum window quality = "+str(minimum_quality))
+        print("quality window size = "+str(window))
+    print("processes = "+str(processes))
+    if log_file:
+        print("detail log file = "+log_file)
+    if report_file:
+        print("json report file = "+report_file)
+    print("")
 
 
     #--------------
     #The main event
     #--------------
-    header = ""
-    string = ""
-    stringa = "(A|X|N){"+str(poly_length)+"}"
-    stringt = "(T|X|N){"+str(poly_length)+"}"
-    count_removed = 0
-    count_chimera = 0
-    count_too_short = 0
-    count_salvaged = 0
-    count_total = 0
-    count_trimmed = 0
-
-    lines = IN.readlines()
-    for line in lines:
-        if re.search("^>",line):
-            if len(header)>0 and len(string)>0:
-                count_total+=1
-                if re.search(stringa,string) or re.search(stringt,string):
-                    newstring = trim_it(header, string, stringa, stringt)
-                    if len(newstring) < len(string):
-                        count_trimmed += 1
-                        string = newstring
-                    if len(string) < int(minimum_sequence_length):
-                        REMOVED.write(header)
-                        REMOVED.write(string+"\n")
-                        print("Removed too short: "+str(header))
-                        count_removed+=1
-                        count_too_short+=1
-                    elif re.search(stringa,string) or re.search(stringt,string):
-                        if remove_chimera_flag == 1:
-                            REMOVED.write(header)
-                            REMOVED.write(string+"\n")
-                            print("Removed as chimera (Poly(A/T) in middle): "+str(header))
-                            count_removed+=1
-                            count_chimera+=1
-                        else:
-                            SALVAGED.write(header)
-                            SALVAGED.write(string+"\n")
-                            count_salvaged+=1
-                            count_chimera+=1
-                    else:
-                        SALVAGED.write(header)
-                        SALVAGED.write(string+"\n")
-                        count_salvaged+=1
-                else:
-                    SALVAGED.write(header)
-                    SALVAGED.write(string+"\n")
-                    count_salvaged+=1
-            string = ""
-            header = line
-        else:
-            line = line.rstrip()
-            string = string + line
-    #ENDFOR
-    if len(header)>0 and len(string)>0:
-        count_total+=1
-        if re.search(stringa,line) or re.search(stringt,line):
-            newstring = trim_it(header, string, stringa, stringt)
-            if len(newstring) < len(string):
-                count_trimmed += 1
-                string = newstring
-            if len(string) < int(minimum_sequence_length):
-                REMOVED.write(header)
-                REMOVED.write(string+"\n")
-                print("Removed too short: "+str(header))
-                count_removed+=1
-                count_too_short+=1
-            elif re.search(stringa,string) or re.search(stringt,string):
-                if remove_chimera_flag == 1:
-                    REMOVED.write(header)
-                    REMOVED.write(string+"\n")
-                    print("Removed as chimera (Poly(A/T) in middle): "+str(header))
-                    count_removed+=1
-                    count_chimera+=1
-                else:
-                    SALVAGED.write(header)
-                    SALVAGED.write(string+"\n")
-                    count_salvaged+=1
-                    count_chimera+=1
-            else:
-                SALVAGED.write(header)
-                SALVAGED.write(string+"\n")
-                count_salvaged+=1
-        else:
-            SALVAGED.write(header)
-            SALVAGED.write(string+"\n")
-            count_salvaged+=1
+    #Records are read in batches and trimmed by trim_batch, either here or in
+    #a pool of worker processes. Either way the batches come back in input
+    #order, so both output files (and the detail log) match a single process run.
+    poly_length = int(poly_length)
+    minimum_sequence_length = int(minimum_sequence_length)
+    start_time = time.time()
+    settings = (poly_length, minimum_sequence_length, remove_chimera_flag, minimum_quality, window, LOG is not None)
+    init_trim(*settings)
+    if MATE is not None:
+        records = read_pairs(IN, MATE)
+    elif fastq:
+        records = ((entry,) for entry in read_fastq(IN))
+    else:
+        records = (((header, string, None),) for header, string in read_fasta(IN) if len(string) > 0)
+    batches = batch_records(records, size=record_size)
+    totals = dict.fromkeys(COUNTERS, 0)
+    lengths_before = Counter()
+    lengths_after = Counter()
+    pool = None
+    if processes > 1:
+        pool = Pool(processes, initializer=init_trim, initargs=settings)
+        results = ordered_map(pool, trim_batch, batches, processes * 4)
+    else:
+        results = map(trim_batch, batches)
+    try:
+        for salvaged, removed, messages, counts, before, after in results:
+            for m in range(len(SALVAGED)):
+                SALVAGED[m].write(salvaged[m])
+                REMOVED[m].write(removed[m])
+            if LOG is not None:
+                LOG.write("".join(messages))
+            for key in COUNTERS:
+                totals[key] += counts[key]
+            lengths_before.update(before)
+            lengths_after.update(after)
+    except ValueError as error:
+        print("\n"+str(error))
+        sys.exit(2)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    count_removed = totals["removed"]
+    count_chimera = totals["chimera"]
+    count_too_short = totals["too_short"]
+    count_salvaged = totals["salvaged"]
+    count_total = totals["total"]
+    count_trimmed = totals["trimmed"]
 
     IN.close()
-    SALVAGED.close()
-    REMOVED.close()
+    if MATE is not None:
+        MATE.close()
+    for OUT in SALVAGED + REMOVED:
+        OUT.close()
+    if LOG is not None:
+        LOG.close()
 
     print("REMOVED = "+str(count_removed))
     print("REMOVED TOO SHORT = "+str(count_too_short))
@@ -221,6 +451,30 @@ def main(argv):
     print("TRIMMED = "+str(count_trimmed))
     print("TOTAL = "+str(count_total))
 
+    #---------------------
+    #Write the JSON report
+    #---------------------
+    if report_file:
+        wall_time = time.time() - start_time
+        report = {
+            "input": [in_file, mate_file] if mate_file else [in_file],
+            "parameters": {"minimum_sequence_length": minimum_sequence_length, "poly_length": poly_length,
+                           "remove_chimera_flag": remove_chimera_flag, "minimum_quality": minimum_quality,
+                           "window": window, "processes": processes},
+            "counts": totals,
+            "lengths_before": length_summary(lengths_before),
+            "lengths_after": length_summary(lengths_after),
+            "wall_time_seconds": wall_time,
+            "records_per_second": count_total / wall_time if wall_time > 0 else 0,
+            #ru_maxrss is in kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "peak_worker_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+        REPORT = open(report_file,"w")
+        json.dump(report, REPORT, indent=2)
+        REPORT.write("\n")
+        REPORT.close()
+
 
     
 if __name__ == "__main__":